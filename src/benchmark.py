@@ -0,0 +1,223 @@
+"""
+Benchmarks of fixed workloads of a sweep.
+
+Every workload runs in its own process and reports:
+
+- `throughput`: the replicates (or fixation probabilities, or rows) per
+  second;
+- `peak_rss_mb`: the peak resident memory of the process;
+- `startup_seconds`: the time taken to import the modules of the sweep.
+
+Run with
+
+    $ python benchmark.py ../data/benchmark.json [<baseline.json>]
+
+to write the results to a json file and compare them to a baseline: a workload
+whose throughput falls by more than 10% is reported as a regression.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# For tests
+import unittest
+
+# (name, first player, second player) of the pairs of write_winner
+PAIRS = [("deterministic", "Cooperator", "Defector"),
+         ("stochastic fast fixation", "Defector", "Random"),
+         ("stochastic slow fixation", "GTFT", "Random")]
+SIZES = [2, 7, 14]
+
+
+def players_and_outcomes(names, turns=200, repetitions=1000):
+    """
+    Return players of the given strategies and a dictionary mapping pairs of
+    their names to their outcome distributions.
+    """
+    import axelrod as axl
+    import generate_cache
+
+    players = [getattr(axl, name)() for name in names]
+    outcomes = {}
+    for p1, p2 in generate_cache.generate_matchups(players):
+        match = axl.Match((p1, p2), turns=turns)
+        counter = generate_cache.outcome_counts(match, repetitions)
+        outcomes[(str(p1), str(p2))] = axl.Pdf(counter)
+        reverse = {(s2, s1): count for (s1, s2), count in counter.items()}
+        outcomes[(str(p2), str(p1))] = axl.Pdf(reverse)
+    return players, outcomes
+
+
+def write_winner_workload(engine, repetitions=100):
+    """Run moran.write_winner for the representative pairs at every N."""
+    import moran
+
+    names = sorted({name for _, p1, p2 in PAIRS for name in (p1, p2)})
+    moran.players, moran.match_outcomes = players_and_outcomes(names)
+    ids = list(range(len(names)))
+    replicates = 0
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        for _, p1, p2 in PAIRS:
+            for N in SIZES:
+                moran.write_winner(directory + "/sims.csv", ids, N,
+                                   names.index(p1), names.index(p2),
+                                   repetitions, engine=engine)
+                replicates += repetitions
+    return replicates, time.perf_counter() - start
+
+
+def theoretic_workload(strategies=40):
+    """Compute theoretic.fixation for every pair of synthetic strategies."""
+    import numpy as np
+    import theoretic
+
+    rng = np.random.default_rng(0)
+    utilities = {(s1, s2): tuple(rng.uniform(0, 5, 2))
+                 for s1 in range(strategies) for s2 in range(s1, strategies)}
+    count = 0
+    start = time.perf_counter()
+    for s1 in range(strategies):
+        for s2 in range(s1 + 1, strategies):
+            for N in SIZES:
+                theoretic.fixation((s1, s2), N, 1, utilities)
+                count += 1
+    return count, time.perf_counter() - start
+
+
+def read_csv_workload(rows=200000):
+    """Read a synthetic outcome cache with generate_cache.read_csv."""
+    import csv
+    import numpy as np
+    import generate_cache
+    from players import fsm_players
+
+    names = [str(player) for player in fsm_players] + [
+        "Player {}".format(k) for k in range(50)]
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = directory + "/outcomes.csv"
+        with open(filename, "w") as f:
+            writer = csv.writer(f)
+            for k in range(rows):
+                writer.writerow([names[k % len(names)],
+                                 names[(k // len(names)) % len(names)],
+                                 *rng.integers(0, 1000, 2) / 200,
+                                 rng.integers(1, 10)])
+        start = time.perf_counter()
+        generate_cache.read_csv(filename)
+        return rows, time.perf_counter() - start
+
+
+def run_simulations_workload(repetitions=50):
+    """Run a miniature sweep with moran.run_simulations."""
+    import moran
+
+    names = ["Cooperator", "Defector", "GTFT", "Random"]
+    moran.players, moran.match_outcomes = players_and_outcomes(names)
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        moran.run_simulations(N=4, repetitions=repetitions,
+                              outfilename=directory + "/sims_4.csv")
+    replicates = repetitions * len(names) * (len(names) - 1)
+    return replicates, time.perf_counter() - start
+
+
+WORKLOADS = {"write_winner_count": lambda: write_winner_workload("count"),
+             "write_winner_batch": lambda: write_winner_workload("batch"),
+             "theoretic_fixation": theoretic_workload,
+             "read_csv": read_csv_workload,
+             "run_simulations": run_simulations_workload}
+
+
+def run_workload(name):
+    """Return the measurements of a workload run in this process."""
+    start = time.perf_counter()
+    # The modules of the sweep, imported here to time their import
+    import axelrod
+    import generate_cache
+    import moran
+    import theoretic
+    startup = time.perf_counter() - start
+
+    count, seconds = WORKLOADS[name]()
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"count": count, "seconds": seconds,
+            "throughput": count / seconds, "peak_rss_mb": peak,
+            "startup_seconds": startup}
+
+
+def run_benchmarks(names=None):
+    """Run every workload in its own process and return their measurements."""
+    results = {}
+    for name in names or sorted(WORKLOADS):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "run", name],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        results[name] = json.loads(output.decode().splitlines()[-1])
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Return the (workload, ratio) of the workloads whose throughput is more
+    than tolerance below the baseline, ratio being current / baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name in baseline:
+            ratio = result["throughput"] / baseline[name]["throughput"]
+            if ratio < 1 - tolerance:
+                regressions.append((name, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "run":
+        print(json.dumps(run_workload(sys.argv[2])))
+        sys.exit()
+
+    results = run_benchmarks()
+    with open(sys.argv[1], "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for name, result in sorted(results.items()):
+        print("{}: {:.1f}/s, {:.0f} MB, startup {:.2f}s".format(
+            name, result["throughput"], result["peak_rss_mb"],
+            result["startup_seconds"]))
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        for name, ratio in regressions:
+            print("Regression: {} at {:.0%} of the baseline".format(name,
+                                                                   ratio))
+        sys.exit(1 if regressions else 0)
+
+
+#########
+# Tests #
+#########
+
+
+class TestCompare(unittest.TestCase):
+    def test_compare(self):
+        baseline = {"a": {"throughput": 100}, "b": {"throughput": 100}}
+        results = {"a": {"throughput": 95}, "b": {"throughput": 50},
+                   "c": {"throughput": 1}}
+        self.assertEqual(compare(results, baseline), [("b", 0.5)])
+        self.assertEqual(compare(results, baseline, tolerance=0.01),
+                         [("a", 0.95), ("b", 0.5)])
+
+
+class TestWorkloads(unittest.TestCase):
+    def test_run_workload(self):
+        result = run_workload("theoretic_fixation")
+        self.assertEqual(result["count"], 40 * 39 // 2 * len(SIZES))
+        self.assertGreater(result["throughput"], 0)
+        self.assertGreater(result["peak_rss_mb"], 0)
@@ -2,60 +2,83 @@
 A script to clean the raw data
 """
 import csv
+from pathlib import Path
+
 import preproces
 import pandas as pd
 
+# For tests
+import tempfile
+import unittest
 
-def read():
-    # Read in the player representations
-    with open("../data/players.csv", "r") as f:
-        reader = csv.reader(f)
-        index_to_players = {row[0]: row[1] for row in reader}
 
-    # Read in the data
-    data = []
-    for N in range(2, 14 + 1):
-        # Read N = 2 data
-        for filename in ["../data/sims_n_over_2/sims_{}.csv".format(N),
-                         "../data/sims_1/sims_{0:02d}.csv".format(N)]:
+def read_players(directory="../data"):
+    """Return a series mapping the ids of players.csv to player names."""
+    players = pd.read_csv(Path(directory) / "players.csv", header=None,
+                          names=["id", "name", "stochastic", "hash"],
+                          usecols=["id", "name"], dtype={"name": str},
+                          keep_default_na=False)
+    return players.set_index("id")["name"]
 
-            noise = "noise" in filename
-            i = 1 if "sims_1/" in filename else N // 2
 
+def read(directory="../data"):
+    directory = Path(directory)
+    names = read_players(directory)
+
+    # Read every shard of raw data at once
+    shards = []
+    for N in range(2, 14 + 1):
+        for filename, i in [("sims_n_over_2/sims_{}.csv".format(N), N // 2),
+                            ("sims_1/sims_{0:02d}.csv".format(N), 1)]:
             try:
-                with open(filename, "r") as f:
-                    reader = csv.reader(f)
-                    for row in reader:
+                shard = pd.read_csv(directory / filename, header=None,
+                                    names=["index1", "index2", "indexwinner",
+                                           "Winner count"])
+            except (FileNotFoundError, pd.errors.EmptyDataError):
+                continue
+            shard["N"] = N
+            shard["i"] = i
+            shards.append(shard)
+    if not shards:
+        return pd.DataFrame(columns=["Noise", "N", "i", "P1", "P2",
+                                     "Winner", "Winner count"])
+    data = pd.concat(shards, ignore_index=True)
 
-                        index1, index2, indexwinner, winnercount = row
+    data["Noise"] = False
+    for index, column in [("index1", "P1"), ("index2", "P2"),
+                          ("indexwinner", "Winner")]:
+        data[column] = names.reindex(data[index]).to_numpy()
+    return data[["Noise", "N", "i", "P1", "P2", "Winner", "Winner count"]]
 
-                        p1 = index_to_players[index1]
-                        p2 = index_to_players[index2]
-                        winner = index_to_players[indexwinner]
 
-                        data.append([noise, int(N), i, p1, p2, winner, int(winnercount)])
-            except FileNotFoundError:
-                pass
+def summarise(full_data):
+    """
+    Return a data frame with the repetitions and fixation probabilities of
+    both players for every pair, N, i and noise.
+    """
+    keys = ["P1", "P2", "N", "i", "Noise"]
+    counts = full_data["Winner count"]
+    full_data = full_data.assign(
+        P1_wins=counts.where(full_data["Winner"] == full_data["P1"], 0),
+        P2_wins=counts.where(full_data["Winner"] == full_data["P2"], 0))
+    summary = full_data.groupby(keys, sort=True)[
+        ["Winner count", "P1_wins", "P2_wins"]].sum().reset_index()
 
-    return pd.DataFrame(data, columns=["Noise", "N", "i", "P1", "P2",
-                                       "Winner", "Winner count"])
+    total = summary["Winner count"]
+    return pd.DataFrame({**{key: summary[key] for key in keys},
+                         "Repetitions": total,
+                         "P1 fixation": summary["P1_wins"] / total,
+                         "P2 fixation": summary["P2_wins"] / total})
 
-def write(full_data):
+
+def write(full_data, directory="../data"):
     # Clean and write the data to file.
-    with open("../data/sims_summary.csv", "w") as f:
+    summary = summarise(full_data)
+    with (Path(directory) / "sims_summary.csv").open("w") as f:
         writer = csv.writer(f)
-        writer.writerow(["P1", "P2", "N", "i", "Noise",
-                         "Repetitions", "P1 fixation", "P2 fixation"])
-        for index, df in full_data.groupby(["P1", "P2", "N", "i", "Noise"]):
-
-            total = df["Winner count"].sum()
-
-            fixation_probabilities = []
-            for rep in range(2):
-                count = float(df[df["Winner"] == index[rep]]["Winner count"].sum())
-                fixation_probabilities.append(count / total)
+        writer.writerow(summary.columns)
+        writer.writerows(summary.itertuples(index=False, name=None))
 
-            writer.writerow([*index, total, *fixation_probabilities])
 
 if __name__ == "__main__":
     print("Reading raw data")
@@ -67,3 +90,37 @@ if __name__ == "__main__":
     fitness_df = preproces.read()
     print("Writing main data")
     preproces.write(fitness_df)
+
+
+#########
+# Tests #
+#########
+
+
+class TestPipeline(unittest.TestCase):
+    def test_summary_and_main(self):
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            (directory / "sims_1").mkdir()
+            (directory / "sims_n_over_2").mkdir()
+            (directory / "players.csv").write_text(
+                "0,Cooperator,False\n1,Defector,False,0123456789abcdef\n")
+            (directory / "sims_1/sims_04.csv").write_text(
+                "0,1,0,1\n0,1,1,3\n1,0,1,4\n1,0,0,0\n")
+            (directory / "sims_n_over_2/sims_4.csv").write_text(
+                "0,1,0,0\n0,1,1,2\n0,1,1,2\n")
+
+            write(read(directory), directory)
+            with (directory / "sims_summary.csv").open("r") as f:
+                self.assertEqual(f.read().splitlines(), [
+                    "P1,P2,N,i,Noise,Repetitions,P1 fixation,P2 fixation",
+                    "Cooperator,Defector,4,1,False,4,0.25,0.75",
+                    "Cooperator,Defector,4,2,False,4,0.0,1.0",
+                    "Defector,Cooperator,4,1,False,4,1.0,0.0"])
+
+            preproces.write(preproces.read(directory), directory)
+            with (directory / "main.csv").open("r") as f:
+                self.assertEqual(f.read().splitlines(), [
+                    "player,opponent,N,$p_1$,$p_{N/2}$,$p_{N-1}$",
+                    "Cooperator,Defector,4,0.25,0.0,0.0",
+                    "Defector,Cooperator,4,1.0,,0.75"])
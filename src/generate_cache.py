@@ -3,9 +3,21 @@ import csv
 import functools
 import multiprocessing
 import os
+import sys
 
 import axelrod as axl
 
+import match_engine
+from players import strategy_hash
+import progress
+import results
+import schedule
+import work_queue
+
+# For tests
+import tempfile
+import unittest
+
 def write_csv(outcomes, filename="outcomes.csv", append=False):
     s = 'w'
     if append:
@@ -39,6 +51,60 @@ def generate_matchups_indices(num_players):
         for j in range(i, num_players):
             yield i, j
 
+def written_pairs(filename):
+    """
+    Return the set of pairs of player names, in both orders, with outcomes in
+    filename.
+    """
+    pairs = set()
+    try:
+        with open(filename, "r") as f:
+            for row in csv.reader(f):
+                pairs.add((row[0], row[1]))
+                pairs.add((row[1], row[0]))
+    except FileNotFoundError:
+        pass
+    return pairs
+
+
+def missing_matchups(players, filename, recorded=None):
+    """
+    Return the (i, j) indices of the matchups of players that have no
+    outcomes in filename.
+
+    recorded are the pairs of strategy_hash with outcomes, in either order, as
+    kept by the progress index. If it is None, as for files written before the
+    index, pairs are matched by player names in filename instead.
+    """
+    if recorded is None:
+        keys = [str(player) for player in players]
+        written = written_pairs(filename)
+    else:
+        keys = [strategy_hash(player) for player in players]
+        written = set(recorded) | {(h2, h1) for h1, h2 in recorded}
+    return [(i, j) for i, j in generate_matchups_indices(len(players))
+            if (keys[i], keys[j]) not in written]
+
+def outcome_counts(match, repetitions):
+    """
+    Play a match repetitions times, once if it is not stochastic, and return
+    a counter of its scores per turn, counted as they are played.
+
+    Stochastic matches between memory-one or finite state machine players
+    are played all at once by the batched engine (see `match_engine.py`).
+    """
+    if not match._stochastic:
+        repetitions = 1
+    elif match_engine.supports(match.players):
+        return match_engine.outcome_counts(match.players, match.turns,
+                                           repetitions, match.noise,
+                                           match.game)
+    counts = Counter()
+    for _ in range(repetitions):
+        match.play()
+        counts[match.final_score_per_turn()] += 1
+    return counts
+
 def sample_match_outcomes(players, turns, repetitions, noise=0):
     """
     Play all matches between pairs of players and return a dictionary mapping
@@ -50,84 +116,217 @@ def sample_match_outcomes(players, turns, repetitions, noise=0):
     for pairs in matchups:
 
         match = axl.Match(pairs, turns=turns, noise=noise)
-        rs = repetitions
-        if not match._stochastic:
-            rs = 1
-        outcomes = []
-        for _ in range(rs):
-            match.play()
-            outcomes.append(match.final_score_per_turn())
-
-        counts = Counter(outcomes)
-
         player_names = tuple(map(str, pairs))
-        match_outcomes[player_names] = counts
+        match_outcomes[player_names] = outcome_counts(match, repetitions)
 
     return match_outcomes
 
-def write_winner(filename, turns, repetitions, noise, i, j, seed=None):
+def sample_winner(turns, repetitions, noise, i, j, seed=None):
     """
-    Write the scores of a match between two players to file
+    Return the rows [player1, player2, score1, score2, count] of the scores of
+    a match between two players
     """
     if seed:
         axl.seed(seed)  # Seed the process
 
     pairs = (players[i].clone(), players[j].clone())
     match = axl.Match(pairs, turns=turns, noise=noise)
-    rs = repetitions
-    if not match._stochastic and noise == 0:
-        rs = 1
-    outcomes = []
-    for _ in range(rs):
-        match.play()
-        outcomes.append(match.final_score_per_turn())
-
-    counts = Counter(outcomes)
+    counts = outcome_counts(match, repetitions)
     player_names = tuple(map(str, pairs))
-    match_outcomes = dict()
-    match_outcomes[player_names] = counts
-    write_csv(match_outcomes, filename=filename, append=True)
+    return [[*player_names, *scores, count]
+            for scores, count in counts.items()]
+
+
+def write_winner(filename, turns, repetitions, noise, i, j, seed=None):
+    """
+    Write the scores of a match between two players to file
+    """
+    rows = sample_winner(turns, repetitions, noise, i, j, seed)
+    with open(filename, 'a') as f:
+        csv.writer(f).writerows(rows)
 
 
 def sample_match_outcomes_parallel(turns, repetitions, filename, noise=0,
-                                   processes=None):
+                                   processes=None, queue=None):
     """
     Parallel matches.
+
+    Only the matchups that are not already in filename are played and
+    appended to it: when players are added, only their matchups are played.
+
+    If processes is not None, the pairs are sampled by a pool of that many
+    processes (all available cpus if 0), the most expensive first. In either
+    case the outcomes of a pair are written as soon as it is sampled, and the
+    pair is recorded in the progress index by the strategy_hash of its
+    players. The outcomes of a pair are written at once, so pairs are not
+    split.
+
+    If a queue directory is given, the pairs are sampled by the workers of
+    that queue instead of a pool of processes (see `work_queue.py`).
     """
+    # Remove the outcomes written after the last record of the index
+    index = progress.ProgressIndex(progress.progress_filename(filename),
+                                   filename)
+    index.synchronise(filename)
+    results.repair(filename)
 
-    player_indices = range(len(players))
-    if processes is None:
-        for i in player_indices:
-            print(i, len(players))
-            for j in player_indices:
-                for seed in range(repetitions):
-                    write_winner(filename, turns, repetitions, noise, i, j,
-                                 seed)
-    else:
-        func = functools.partial(write_winner, filename, turns, repetitions,
-                                 noise)
-        p = multiprocessing.Pool(processes)
+    hashes = [strategy_hash(player) for player in players]
+    if index.size() is None and os.path.exists(filename):
+        # A file written before the index: record its pairs by name once
+        written = set(generate_matchups_indices(len(players))) - set(
+            missing_matchups(players, filename))
+        index.record([((hashes[i], hashes[j]), 0, repetitions)
+                      for i, j in sorted(written)],
+                     os.path.getsize(filename))
+    timings = index.timings()
+    tasks = [(pair, 0, repetitions)
+             for pair in missing_matchups(players, filename, index.ranges())]
+    if processes is not None or queue is not None:
+        costs = schedule.costs(
+            tasks, lambda pair: schedule.match_cost(
+                players[pair[0]], players[pair[1]], repetitions,
+                noise) / repetitions,
+            {(i, j): timings[(hashes[i], hashes[j])]
+             for (i, j), _, _ in tasks if (hashes[i], hashes[j]) in timings})
+        tasks = schedule.schedule(tasks, costs, processes, split=False)
+
+    # Only this process writes to the output file
+    func = functools.partial(sample_winner, turns, repetitions, noise)
+    args = (pair for pair, _, _ in tasks)
+    results.write_results(func, args, filename, processes=processes,
+                          progress=index,
+                          record=lambda pair: [((hashes[pair[0]],
+                                                 hashes[pair[1]]),
+                                                0, repetitions)],
+                          queue=queue)
+    index.close()
 
-        args = generate_matchups_indices(len(players))
-        p.starmap(func, args)
+
+def work(queue):
+    """Sample the pairs put in a queue by sample_match_outcomes_parallel."""
+    return work_queue.work(queue, {"sample_winner": sample_winner})
 
 
 if __name__ == "__main__":
+    # Run with `python generate_cache.py [<queue>]`
+    # and the workers of a queue with `python generate_cache.py worker <queue>`
     # players are global
     from players import selected_players
     players = selected_players()
 
-    print(len(list(map(str, players))))
+    if sys.argv[1:2] == ["worker"]:
+        work(sys.argv[2])
+        sys.exit()
 
     try:
-        os.remove("../data/missing_fsm_outcomes.csv")
-    except FileNotFoundError:
-        pass
+        queue = sys.argv[1]  # Directory shared with the workers
+    except IndexError:
+        queue = None
+
+    print(len(list(map(str, players))))
 
     repetitions = 1000
     turns = 200
 
     cpu_count = multiprocessing.cpu_count()
     sample_match_outcomes_parallel(turns=turns, repetitions=repetitions,
-                                   filename="../data/missing_fsm_outcomes.csv", noise=0,
-                                   processes=cpu_count)
+                                   filename="../data/outcomes.csv", noise=0,
+                                   processes=cpu_count, queue=queue)
+
+
+#########
+# Tests #
+#########
+
+
+class TestMissingMatchups(unittest.TestCase):
+    """Test that only the matchups of new players are played"""
+    def test_missing_matchups(self):
+        players = [axl.Cooperator(), axl.Defector(), axl.TitForTat()]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/outcomes.csv"
+            self.assertEqual(len(missing_matchups(players, filename)), 6)
+            write_csv({("Cooperator", "Cooperator"): Counter({(3, 3): 1}),
+                       ("Defector", "Cooperator"): Counter({(5, 0): 1})},
+                      filename)
+            self.assertEqual(missing_matchups(players, filename),
+                             [(0, 2), (1, 1), (1, 2), (2, 2)])
+            # The order of the players does not matter
+            self.assertEqual(missing_matchups(players[::-1], filename),
+                             [(0, 0), (0, 1), (0, 2), (1, 1)])
+
+    def test_recorded(self):
+        players = [axl.Cooperator(), axl.Defector(), axl.TitForTat()]
+        hashes = [strategy_hash(player) for player in players]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/outcomes.csv"
+            # Names in the file are ignored once pairs are recorded
+            write_csv({("Cooperator", "Defector"): Counter({(0, 5): 1})},
+                      filename)
+            recorded = [(hashes[0], hashes[0]), (hashes[2], hashes[1])]
+            self.assertEqual(missing_matchups(players, filename, recorded),
+                             [(0, 1), (0, 2), (1, 1), (2, 2)])
+            # A strategy renamed keeps its pairs
+            players[1].name = "Renamed"
+            self.assertEqual(missing_matchups(players, filename, recorded),
+                             [(0, 1), (0, 2), (1, 1), (2, 2)])
+
+    def test_sample_match_outcomes_parallel(self):
+        global players
+        players = [axl.Cooperator(), axl.Defector()]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/outcomes.csv"
+            sample_match_outcomes_parallel(5, 2, filename, processes=1)
+            self.assertEqual(len(read_csv(filename)), 4)
+            players = [axl.TitForTat(), axl.Defector(), axl.Cooperator()]
+            sample_match_outcomes_parallel(5, 2, filename, processes=1)
+            outcomes = read_csv(filename)
+            self.assertEqual(len(outcomes), 9)
+            self.assertEqual(outcomes[("Tit For Tat", "Defector")],
+                             Counter({(0.8, 1.8): 1}))
+            with open(filename, "r") as f:
+                self.assertEqual(len(f.readlines()), 6)
+
+    def test_legacy_file(self):
+        global players
+        players = [axl.Cooperator(), axl.Defector()]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/outcomes.csv"
+            write_csv({("Cooperator", "Cooperator"): Counter({(3, 3): 1}),
+                       ("Cooperator", "Defector"): Counter({(0, 5): 1})},
+                      filename)
+            sample_match_outcomes_parallel(5, 2, filename, processes=1)
+            with open(filename, "r") as f:
+                self.assertEqual(len(f.readlines()), 3)
+            index = progress.ProgressIndex(
+                progress.progress_filename(filename))
+            self.assertEqual(len(index.ranges()), 3)
+            index.close()
+
+    def test_serial(self):
+        global players
+        players = [axl.Random(), axl.Cooperator()]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/outcomes.csv"
+            sample_match_outcomes_parallel(5, 20, filename)
+            with open(filename, "r") as f:
+                rows = list(csv.reader(f))
+            counts = Counter()
+            for row in rows:
+                counts[(row[0], row[1])] += int(row[4])
+            # Every pair is played repetitions times, once if deterministic
+            self.assertEqual(counts,
+                             Counter({("Random: 0.5", "Random: 0.5"): 20,
+                                      ("Random: 0.5", "Cooperator"): 20,
+                                      ("Cooperator", "Cooperator"): 1}))
+
+
+class TestOutcomeCounts(unittest.TestCase):
+    def test_outcome_counts(self):
+        match = axl.Match((axl.Cooperator(), axl.Defector()), turns=5)
+        self.assertEqual(outcome_counts(match, 100), Counter({(0, 5): 1}))
+        match = axl.Match((axl.Random(), axl.Defector()), turns=5)
+        self.assertEqual(sum(outcome_counts(match, 100).values()), 100)
+        # Not supported by the batched engine
+        match = axl.Match((axl.Random(), axl.Grudger()), turns=5)
+        self.assertEqual(sum(outcome_counts(match, 100).values()), 100)
@@ -1,6 +1,10 @@
 """
 Runs a spatial tournament on a bi partite graph and writes data with the mean
 cooperation rate of players of one cluster against all players
+
+With `stream=True` the matches are played without writing their interactions:
+the number of times the player cooperates in every round is counted as they
+are played and only the final array is written.
 """
 
 import axelrod as axl
@@ -10,11 +14,14 @@ import multiprocessing
 import os
 import csv
 
-from abbreviations import abbreviations
+# For tests
+import unittest
+
+from abbreviations import abbreviation
 from players import selected_players
 players = [p for p in selected_players()
 			if ("length" not in p.classifier["makes_use_of"]) and
-                           ("Incorrect" not in abbreviations[str(p)])]
+                           ("Incorrect" not in abbreviation(p))]
 
 def obtain_cooperation_matrix(filename, number_of_turns=200):
     data = []
@@ -25,10 +32,99 @@ def obtain_cooperation_matrix(filename, number_of_turns=200):
     df = pd.DataFrame(data, columns=["player", "opponent"] + ["Round {}".format(n) for n in range(number_of_turns)])
     return np.array(df.groupby(["player", "opponent"]).mean())
 
+def cooperation_counts(args):
+    """
+    Return the number of times each player cooperates in every round of
+    `repetitions` matches between player and opponent.
+    """
+    player, opponent, turns, repetitions, noise, seed = args
+    axl.seed(seed)
+    match = axl.Match((player.clone(), opponent.clone()), turns=turns,
+                      noise=noise)
+    counts = np.zeros((2, turns), dtype=np.int64)
+    for _ in range(repetitions):
+        match.play()
+        counts += np.array(match.result).T == axl.Actions.C
+    return counts
+
+def cooperation_matrix(opponents, counts, repetitions):
+    """
+    Return the mean cooperation rate in every round against every opponent,
+    one row per opponent name in the order of obtain_cooperation_matrix.
+    """
+    totals = {}
+    for opponent, count in zip(opponents, counts):
+        total, matches = totals.get(str(opponent), (0, 0))
+        totals[str(opponent)] = (total + count, matches + repetitions)
+    return np.array([total / matches
+                     for _, (total, matches) in sorted(totals.items())])
+
+def stream_cooperation_matrices(indices, players, processes, seed, turns,
+                                repetitions, noise):
+    """
+    Play the matches of players[index] against all players, for every index,
+    and return a dictionary mapping indices to cooperation matrices without
+    writing the interactions.
+
+    A matchup is played once, with a seed depending only on the pair, even if
+    both of its players are in indices.
+    """
+    pairs = sorted({tuple(sorted((index, j)))
+                    for index in indices for j, _ in enumerate(players)})
+    tasks = [(players[i], players[j], turns, repetitions, noise,
+              int(np.random.SeedSequence([seed, i, j]).generate_state(1)[0]))
+             for i, j in pairs]
+    if processes == 1:
+        counts = list(map(cooperation_counts, tasks))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            counts = pool.map(cooperation_counts, tasks)
+    counts = dict(zip(pairs, counts))
+
+    matrices = {}
+    for index in indices:
+        rows = [counts[(index, j)][0] if index <= j else counts[(j, index)][1]
+                for j, _ in enumerate(players)]
+        matrices[index] = cooperation_matrix(players, rows, repetitions)
+    return matrices
+
+def stream_cooperation_matrix(index, players, processes, seed, turns,
+                              repetitions, noise):
+    """
+    Play the matches of players[index] against all players and return its
+    cooperation matrix without writing the interactions.
+    """
+    return stream_cooperation_matrices([index], players, processes, seed,
+                                       turns, repetitions, noise)[index]
+
+def output_filename(index, players, seed, noise, repetitions):
+    prefix = "{}_{}_{}_{}".format(seed, int(100 * noise), repetitions,
+                                  abbreviation(players[index]))
+    return "../data/cooperation_{}_array.gz".format(prefix)
+
+def main_batch(indices, players=players, processes=None, seed=1, turns=200,
+               repetitions=10000, noise=0):
+    """
+    Write the cooperation arrays of every player of indices, as written by
+    main with stream=True, sharing the pool and the matchups between them.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    matrices = stream_cooperation_matrices(indices, players, processes, seed,
+                                           turns, repetitions, noise)
+    for index, matrix in matrices.items():
+        np.savetxt(fname=output_filename(index, players, seed, noise,
+                                         repetitions),
+                   X=matrix, delimiter=",")
+
 def main(index, players=players, processes=None, seed=1, turns=200, repetitions=10000,
-         noise=0):
+         noise=0, stream=False):
     """
     index of the player in question
+
+    With stream=True, no interactions file is written: see
+    stream_cooperation_matrix.
     """
     edges = [(index, j) for j, _ in enumerate(players)]
     assert (index, index) in edges
@@ -37,10 +133,14 @@ def main(index, players=players, processes=None, seed=1, turns=200, repetitions=
     if processes is None:
         processes = multiprocessing.cpu_count()
 
+    if stream:
+        main_batch([index], players, processes, seed, turns, repetitions,
+                   noise)
+        return
+
     prefix = "{}_{}_{}_{}".format(seed, int(100 * noise), repetitions,
-                                  abbreviations[str(players[index])])
+                                  abbreviation(players[index]))
     interactions_filename = "../data/cooperation_{}_interactions.csv".format(prefix)
-    output_filename = "../data/cooperation_{}_array.gz".format(prefix)
 
     # Deleting the file if it exists
     try:
@@ -64,7 +164,8 @@ def main(index, players=players, processes=None, seed=1, turns=200, repetitions=
                     build_results=False, progress_bar=False)
 
     matrix = obtain_cooperation_matrix(interactions_filename)
-    np.savetxt(fname=output_filename, X=matrix, delimiter=",")
+    np.savetxt(fname=output_filename(index, players, seed, noise, repetitions),
+               X=matrix, delimiter=",")
 
 if __name__ == "__main__":
     import sys
@@ -73,6 +174,50 @@ if __name__ == "__main__":
     repetitions = int(args[0])
     seed = int(args[1])
     noise = float(args[2])
-    index = int(args[3])
+    stream = len(args) > 4 and args[4] == "stream"
+
+    if args[3] == "all" or "," in args[3]:
+        # Several players: always streamed
+        if args[3] == "all":
+            indices = list(range(len(players)))
+        else:
+            indices = [int(index) for index in args[3].split(",")]
+        main_batch(indices, repetitions=repetitions, seed=seed, noise=noise)
+    else:
+        index = int(args[3])
+        main(index=index, repetitions=repetitions, seed=seed, noise=noise,
+             stream=stream)
+
+
+#########
+# Tests #
+#########
+
+
+class TestStreaming(unittest.TestCase):
+    def test_cooperation_counts(self):
+        counts = cooperation_counts((axl.TitForTat(), axl.Alternator(), 5, 3,
+                                     0, 0))
+        np.testing.assert_array_equal(counts, [[3, 3, 0, 3, 0],
+                                               [3, 0, 3, 0, 3]])
+
+    def test_matches_interactions(self):
+        test_players = [axl.TitForTat(), axl.Random(), axl.Alternator()]
+        matrix = stream_cooperation_matrix(0, test_players, 1, 0, 10, 50, 0)
+        self.assertEqual(matrix.shape, (3, 10))
+        # Rows are ordered by opponent name
+        np.testing.assert_array_equal(matrix[0], [1] + [1, 0] * 4 + [1])
+        np.testing.assert_array_equal(matrix[2], [1] * 10)
+        self.assertTrue(0 < matrix[1][1:].mean() < 1)
 
-    main(index=index, repetitions=repetitions, seed=seed, noise=noise)
+    def test_batch(self):
+        test_players = [axl.TitForTat(), axl.Random(), axl.Alternator()]
+        matrices = stream_cooperation_matrices([0, 1, 2], test_players, 1, 0,
+                                               10, 50, 0)
+        for index in range(3):
+            np.testing.assert_array_equal(
+                matrices[index],
+                stream_cooperation_matrix(index, test_players, 1, 0, 10, 50,
+                                          0))
+        # Random against Alternator, seen from both players
+        np.testing.assert_array_equal(matrices[2][1], [1, 0] * 5)
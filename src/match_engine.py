@@ -0,0 +1,211 @@
+"""
+A batched engine playing all the repetitions of a match at once.
+
+A supported player is described as a machine: in state x it cooperates with
+probability `cooperation[x]`, and after it plays a and its opponent plays b it
+moves to state `transitions[x, a, b]`, with actions written 0 for C and 1 for
+D. State 0 is the state before the first turn. Memory-one players (including
+`axl.Random`, `axl.GTFT` and the `axl.MemoryOnePlayer` strategies) and
+`axl.FSMPlayer` strategies are supported. Every repetition is then a row of
+arrays of states and actions, played a turn at a time for all rows at once.
+
+As in `axl.Match`, noise flips the actions played and the players see the
+flipped actions.
+"""
+from collections import Counter
+import random
+
+import axelrod as axl
+import numpy as np
+
+# For tests
+import unittest
+
+C, D = axl.Actions.C, axl.Actions.D
+ACTIONS = [C, D]
+
+
+def memory_one_machine(initial, four_vector):
+    """
+    Return the machine of a memory-one player: the probability of cooperating
+    on the first turn and after each of (C, C), (C, D), (D, C), (D, D).
+    """
+    cooperation = np.array([initial] + list(four_vector), dtype=float)
+    transitions = np.zeros((5, 2, 2), dtype=np.int64)
+    transitions[:] = 1 + 2 * np.arange(2)[:, None] + np.arange(2)[None, :]
+    return cooperation, transitions
+
+
+def fsm_machine(player):
+    """
+    Return the machine of a finite state machine player. Its states, after
+    the first turn, are the pairs of the state of the player and the last
+    action of its opponent.
+    """
+    state_transitions = player.fsm.state_transitions
+    states = sorted({state for state, _ in state_transitions} |
+                    {player.initial_state})
+    index = {state: k for k, state in enumerate(states)}
+    cooperation = np.zeros(1 + 2 * len(states))
+    transitions = np.zeros((1 + 2 * len(states), 2, 2), dtype=np.int64)
+
+    cooperation[0] = player.initial_action == C
+    transitions[0, :, :] = 1 + 2 * index[player.initial_state] + np.arange(2)
+    for state in states:
+        for o, action in enumerate(ACTIONS):
+            try:
+                next_state, move = state_transitions[(state, action)]
+            except KeyError:
+                raise ValueError("Incomplete finite state machine")
+            x = 1 + 2 * index[state] + o
+            cooperation[x] = move == C
+            transitions[x, :, :] = 1 + 2 * index[next_state] + np.arange(2)
+    return cooperation, transitions
+
+
+def player_machine(player):
+    """
+    Return the (cooperation, transitions) arrays of the machine of a player.
+
+    Raises a ValueError if the player is not supported.
+    """
+    kind = type(player)
+    if kind in (axl.Cooperator, axl.Defector, axl.Random):
+        p = {axl.Cooperator: 1, axl.Defector: 0}.get(kind, None)
+        if p is None:
+            p = player.p
+        return memory_one_machine(p, [p] * 4)
+    if kind is axl.TitForTat:
+        return memory_one_machine(1, [1, 0, 1, 0])
+    if (isinstance(player, axl.MemoryOnePlayer) and
+            kind.strategy is axl.MemoryOnePlayer.strategy):
+        vector = player._four_vector
+        return memory_one_machine(player._initial == C,
+                                  [vector[pair] for pair in
+                                   [(C, C), (C, D), (D, C), (D, D)]])
+    if (isinstance(player, axl.FSMPlayer) and
+            kind.strategy is axl.FSMPlayer.strategy):
+        return fsm_machine(player)
+    raise ValueError("{} is not supported".format(player))
+
+
+def supports(players):
+    """Return True if the batched engine can play a match between players"""
+    try:
+        for player in players:
+            player_machine(player)
+    except ValueError:
+        return False
+    return True
+
+
+def play_scores(players, turns, repetitions, noise=0, game=None, rng=None):
+    """
+    Return the arrays of the total scores of both players in `repetitions`
+    matches played at once.
+    """
+    if game is None:
+        game = axl.Game()
+    if rng is None:
+        # Follows the seed set by axl.seed
+        rng = np.random.default_rng(random.getrandbits(64))
+    R, P, S, T = game.RPST()
+    payoffs = np.array([[R, S], [T, P]], dtype=np.int64)
+
+    machines = [player_machine(player) for player in players]
+    states = [np.zeros(repetitions, dtype=np.int64) for _ in machines]
+    scores = [np.zeros(repetitions, dtype=np.int64) for _ in machines]
+    for _ in range(turns):
+        actions = []
+        for (cooperation, _), x in zip(machines, states):
+            # 0 for C: cooperate with probability cooperation[x]
+            action = (rng.random(repetitions) >= cooperation[x]).astype(
+                np.int64)
+            if noise:
+                action ^= rng.random(repetitions) < noise
+            actions.append(action)
+        a, b = actions
+        scores[0] += payoffs[a, b]
+        scores[1] += payoffs[b, a]
+        states[0] = machines[0][1][states[0], a, b]
+        states[1] = machines[1][1][states[1], b, a]
+    return scores
+
+
+def outcome_counts(players, turns, repetitions, noise=0, game=None,
+                   rng=None):
+    """
+    Return a counter of the scores per turn of `repetitions` matches between
+    two players, as counted by generate_cache.outcome_counts.
+    """
+    scores = play_scores(players, turns, repetitions, noise, game, rng)
+    pairs, counts = np.unique(np.column_stack(scores), axis=0,
+                              return_counts=True)
+    return Counter({(int(s1) / turns, int(s2) / turns): int(count)
+                    for (s1, s2), count in zip(pairs, counts)})
+
+
+#########
+# Tests #
+#########
+
+
+class TestMachines(unittest.TestCase):
+    def test_supports(self):
+        self.assertTrue(supports([axl.Random(), axl.GTFT()]))
+        self.assertTrue(supports([axl.WinStayLoseShift(), axl.FSMPlayer()]))
+        self.assertTrue(supports([axl.Cooperator(), axl.TitForTat()]))
+        self.assertFalse(supports([axl.Random(), axl.Grudger()]))
+        self.assertFalse(supports([axl.ArrogantQLearner(), axl.Random()]))
+
+    def test_memory_one_machine(self):
+        cooperation, transitions = player_machine(axl.GTFT())
+        self.assertEqual(cooperation[0], 1)
+        self.assertEqual(cooperation[1], 1)
+        self.assertAlmostEqual(cooperation[2], 1 / 3)
+        # After (D, C) the player is in state 1 + 2 * 1 + 0
+        self.assertEqual(transitions[0, 1, 0], 3)
+
+
+class TestPlay(unittest.TestCase):
+    def assertMatchesAxelrod(self, players, turns=20, noise=0):
+        match = axl.Match([p.clone() for p in players], turns=turns,
+                          noise=noise)
+        match.play()
+        counts = outcome_counts(players, turns, 1, noise)
+        self.assertEqual(counts, Counter([match.final_score_per_turn()]))
+
+    def test_deterministic(self):
+        from players import fsm_players
+        opponents = [axl.Cooperator(), axl.Defector(), axl.TitForTat(),
+                     axl.WinStayLoseShift()]
+        for player in fsm_players:
+            for opponent in opponents + fsm_players:
+                self.assertMatchesAxelrod([player, opponent])
+
+    def test_stochastic(self):
+        players = [axl.GTFT(), axl.Random()]
+        counts = outcome_counts(players, 20, 4000)
+        self.assertEqual(sum(counts.values()), 4000)
+        mean = sum(s1 * c for (s1, _), c in counts.items()) / 4000
+
+        axl.seed(0)
+        match = axl.Match(players, turns=20)
+        expected = 0
+        for _ in range(1000):
+            match.play()
+            expected += match.final_score_per_turn()[0] / 1000
+        self.assertAlmostEqual(mean, expected, delta=0.05)
+
+    def test_noise(self):
+        players = [axl.TitForTat(), axl.Cooperator()]
+        counts = outcome_counts(players, 10, 2000, noise=0.1)
+        mean = sum(s1 * c for (s1, _), c in counts.items()) / 2000
+
+        axl.seed(0)
+        match = axl.Match(players, turns=10, noise=0.1)
+        expected = 0
+        for _ in range(1000):
+            match.play()
+            expected += match.final_score_per_turn()[0] / 1000
+        self.assertAlmostEqual(mean, expected, delta=0.1)
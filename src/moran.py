@@ -6,38 +6,42 @@ import csv
 from pathlib import Path
 import sys
 import functools
-import multiprocessing
 import itertools
+import math
+import random
 
 import axelrod as axl
+import numpy as np
 import pandas as pd
 
-from axelrod import ApproximateMoranProcess, Pdf
-from generate_cache import read_csv
+from axelrod import Pdf
+from outcome_store import read_outcomes, same_outcomes
+import progress
+from registry import read_registry
+import results
+import schedule
+import streams
+import theoretic
+import work_queue
 
 # For tests
+from axelrod import ApproximateMoranProcess
 import collections
+import multiprocessing
 import tempfile
 import unittest
 
 
 def output_players(players, outfilename="players.csv"):
-    """Cache players to disk for later retrieval."""
-    rows = [(i, str(player), player.classifier["stochastic"]) for (i, player) in enumerate(players)]
+    """
+    Register players in the registry kept on disk for later retrieval, and
+    return their ids (see `registry.py`).
+    """
     path = Path("../data") / outfilename
-    with path.open('w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerows(rows)
-
-
-def build_population(players, i, j, weights):
-    """Return the population of strategies according to a given weights"""
-    sub_players = players[i], players[j]
-    population = []
-    for player, weight in zip(sub_players, weights):
-        for _ in range(weight):
-            population.append(player.clone())
-    return population
+    registry = read_registry(path)
+    ids = registry.register(players)
+    registry.write(path)
+    return ids
 
 
 def obtain_current_count(filename):
@@ -52,133 +56,578 @@ def obtain_current_count(filename):
     return counts
 
 
-def write_winner(outfilename, names_inv,
-                 N, i, j, repetitions, n=1):
+def two_type_distributions(outcomes, s1, s2):
     """
-    Write the winner of a Moran process to file
+    Return the (scores, probabilities) arrays of the three interactions that
+    occur in a population of two types: s1 v s1, s1 v s2 and s2 v s2.
     """
+    distributions = []
+    for pair in [(s1, s1), (s1, s2), (s2, s2)]:
+        pdf = outcomes[pair]
+        distributions.append((np.array(pdf.sample_space, dtype=float),
+                              np.array(pdf.probability)))
+    return distributions
 
-    initial_population = build_population(players, i, j, [n, N-n])
 
-    s1 = str(players[i].clone())
-    s2 = str(players[j].clone())
+def sample_scores(distribution, size, rng=np.random):
+    """
+    Return the total scores of both players over `size` independent samples
+    of a match outcome distribution.
+    """
+    if size == 0:
+        return np.zeros(2)
+    scores, probabilities = distribution
+    counts = rng.multinomial(size, probabilities)
+    return np.dot(counts, scores)
+
+
+def population_fitness(distributions, N, count, rng=np.random):
+    """
+    Return the total fitness of all players of each type in a population of
+    N players with `count` players of the first type.
+
+    Every pair of players plays once: this samples the count(count - 1) / 2
+    matches within the first type, the count(N - count) matches between the
+    types and the (N - count)(N - count - 1) / 2 matches within the second
+    type.
+    """
+    same, mixed, other = distributions
+    mixed_scores = sample_scores(mixed, count * (N - count), rng)
+    first = sample_scores(same, count * (count - 1) // 2, rng).sum()
+    second = sample_scores(other, (N - count) * (N - count - 1) // 2,
+                           rng).sum()
+    return first + mixed_scores[0], second + mixed_scores[1]
+
+
+def fixation_count(distributions, N, n, rng=None):
+    """
+    Play a two type approximate Moran process that only keeps track of the
+    number of players of the first type.
+
+    This is equivalent to an ApproximateMoranProcess on a population of n
+    players of the first type and N - n players of the second type: a player
+    is chosen to reproduce proportionally to fitness and replaces a player
+    chosen uniformly at random.
+
+    The random numbers are drawn from rng, a numpy Generator, which by
+    default follows the seed set by axl.seed.
+
+    Returns True if the first type fixes.
+    """
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    count = n
+    while 0 < count < N:
+        fitness = population_fitness(distributions, N, count, rng)
+        # With a total fitness of zero the first type reproduces, as in
+        # axelrod's fitness proportional selection
+        birth = rng.random() * (fitness[0] + fitness[1]) <= fitness[0]
+        death = rng.integers(N) < count
+        count += int(birth) - int(death)
+    return count == N
+
+
+def batch_sample_scores(distribution, sizes, rng):
+    """
+    Return the total scores of both players over `sizes[k]` independent
+    samples of a match outcome distribution, for every k, as an array of
+    shape (len(sizes), 2).
+    """
+    scores, probabilities = distribution
+    counts = rng.multinomial(sizes, probabilities)
+    return np.dot(counts, scores)
+
+
+def batch_population_fitness(distributions, N, counts, rng):
+    """
+    Return the total fitness of each type for an array of populations of N
+    players with `counts` players of the first type.
+    """
+    same, mixed, other = distributions
+    mixed_scores = batch_sample_scores(mixed, counts * (N - counts), rng)
+    first = batch_sample_scores(same, counts * (counts - 1) // 2, rng)
+    second = batch_sample_scores(other, (N - counts) * (N - counts - 1) // 2,
+                                 rng)
+    return (first.sum(axis=1) + mixed_scores[:, 0],
+            second.sum(axis=1) + mixed_scores[:, 1])
+
+
+def batch_fixation(distributions, N, n, repetitions, seed=0, rng=None,
+                   visited=None):
+    """
+    Play `repetitions` two type approximate Moran processes at once.
+
+    The state of every replicate is the number of players of the first type,
+    held in a single array. Each birth death step is applied to all the
+    replicates that have not yet fixed.
+
+    The random numbers are drawn from rng if given, else from a generator
+    seeded with seed.
+
+    If visited, a boolean array of shape (repetitions, N + 1), is given, the
+    states visited by every replicate are marked in it.
+
+    Returns a boolean array: True where the first type fixes.
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    counts = np.full(repetitions, n)
+    active = np.flatnonzero((counts > 0) & (counts < N))
+    if visited is not None:
+        visited[:, n] = True
+    while active.size > 0:
+        current = counts[active]
+        first, second = batch_population_fitness(distributions, N, current,
+                                                 rng)
+        birth = rng.random(active.size) * (first + second) <= first
+        death = rng.integers(N, size=active.size) < current
+        current = current + birth - death
+        counts[active] = current
+        if visited is not None:
+            visited[active, current] = True
+        active = active[(current > 0) & (current < N)]
+    return counts == N
+
+
+def is_deterministic(distributions):
+    """Return True if every interaction has a single possible outcome"""
+    return all(len(scores) == 1 for scores, _ in distributions)
+
+
+def fixation_wins(distributions, N, n, repetitions, engine="count", start=0,
+                  fixation=None, key=(), root_seed=0):
+    """
+    Return the number of Moran processes, replicates start, ..., start +
+    repetitions - 1, in which the first type fixes.
+
+    Each replicate draws from its own random number stream, derived from the
+    root seed and the key (see `streams.py`): the count engine uses one stream
+    per replicate and the batch engine one per block of replicates.
+
+    If the fixation probability is known, whether each replicate fixes is
+    sampled from it instead of running the processes.
+    """
+    wins = 0
+    if fixation is not None or engine == "batch":
+        for block, lower, upper in streams.blocks(start, start + repetitions):
+            rng = streams.block_rng(root_seed, key, block)
+            if fixation is not None:
+                fixed = (rng.random(streams.BLOCK_SIZE) <
+                         np.clip(fixation, 0, 1))
+            else:
+                fixed = batch_fixation(distributions, N, n,
+                                       streams.BLOCK_SIZE, rng=rng)
+            wins += int(fixed[lower:upper].sum())
+        return wins
+    for replicate in range(start, start + repetitions):
+        rng = streams.replicate_rng(root_seed, key, replicate)
+        wins += fixation_count(distributions, N, n, rng)
+    return wins
+
+
+def visit_fixation_wins(distributions, N, n, repetitions, start=0, key=(),
+                        root_seed=0):
+    """
+    Return the (visits, wins) arrays of the replicates start, ..., start +
+    repetitions - 1 of the batch engine, started from n players of the first
+    type: visits[i] of them visited the state with i players of the first
+    type and wins[i] of those then fixed.
+
+    The number of players of the first type is a Markov chain: from its
+    first visit to state i a replicate is a process started from i. So
+    wins[i] / visits[i] estimates the fixation probability from i, for every
+    i visited, from a single set of replicates. The replicates are those of
+    fixation_wins with the batch engine, and wins[n] is its number of wins.
+    """
+    visits = np.zeros(N + 1, dtype=np.int64)
+    wins = np.zeros(N + 1, dtype=np.int64)
+    for block, lower, upper in streams.blocks(start, start + repetitions):
+        rng = streams.block_rng(root_seed, key, block)
+        visited = np.zeros((streams.BLOCK_SIZE, N + 1), dtype=bool)
+        fixed = batch_fixation(distributions, N, n, streams.BLOCK_SIZE,
+                               rng=rng, visited=visited)
+        visits += visited[lower:upper].sum(axis=0)
+        wins += visited[lower:upper][fixed[lower:upper]].sum(axis=0)
+    return visits, wins
+
+
+def visit_fixation(distributions, N, n, repetitions, start=0, key=(),
+                   root_seed=0):
+    """
+    Return the estimates of the fixation probabilities from i = 1, ..., N - 1
+    players of the first type given by visit_fixation_wins, nan for the
+    states that no replicate visited.
+    """
+    visits, wins = visit_fixation_wins(distributions, N, n, repetitions,
+                                       start, key, root_seed)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (wins / visits)[1:N]
+
+
+def wilson_interval(wins, repetitions, z=1.96):
+    """Return the Wilson score interval of a fixation probability"""
+    p = wins / repetitions
+    denominator = 1 + z ** 2 / repetitions
+    centre = (p + z ** 2 / (2 * repetitions)) / denominator
+    half_width = (z / denominator) * math.sqrt(
+        p * (1 - p) / repetitions + z ** 2 / (4 * repetitions ** 2))
+    return centre - half_width, centre + half_width
+
+
+def adaptive_fixation_wins(distributions, N, n, repetitions, tolerance,
+                           batch_size=100, engine="count", start=0,
+                           fixation=None, key=(), root_seed=0):
+    """
+    Run Moran processes in batches of batch_size until the Wilson interval of
+    the fixation probability is narrower than tolerance, or repetitions have
+    been run.
+
+    Returns the number of processes in which the first type fixes and the
+    number of processes run.
+    """
+    wins, run = 0, 0
+    while run < repetitions:
+        size = min(batch_size, repetitions - run)
+        wins += fixation_wins(distributions, N, n, size, engine, start + run,
+                              fixation, key, root_seed)
+        run += size
+        lower, upper = wilson_interval(wins, run)
+        if upper - lower < tolerance:
+            break
+    return wins, run
+
+
+# The outcomes last solved for, and their exact fixation probabilities for
+# every (s1, s2, N), None for those too expensive to solve
+exact_fixations = (None, {})
+
+
+def exact_fixation(s1, s2, N, outcomes=None):
+    """
+    Return the exact fixation probabilities of s1 against s2 for n = 1, ...,
+    N - 1, or None if they are too expensive to solve. The outcomes are
+    match_outcomes by default.
+
+    Each (s1, s2, N) is solved once per process, however many seed ranges it
+    is split into, for as long as the outcomes are the same (or a copy of the
+    same store).
+    """
+    global exact_fixations
+    if outcomes is None:
+        outcomes = match_outcomes
+    solved, fixations = exact_fixations
+    if not same_outcomes(solved, outcomes):
+        fixations = {}
+        exact_fixations = (outcomes, fixations)
+    key = (s1, s2, N)
+    if key not in fixations:
+        try:
+            fixations[key] = theoretic.outcome_fixation((s1, s2), N,
+                                                        outcomes)
+        except ValueError:
+            fixations[key] = None
+    return fixations[key]
+
+
+def simulate_winner(ids, N, i, j, repetitions, n=1, engine="count",
+                    start=0, tolerance=None, batch_size=100, root_seed=0):
+    """
+    Return the rows [i, j, winner, count] of the winners of Moran processes,
+    replicates start, ..., start + repetitions - 1, where players are written
+    as their ids: ids[i] for players[i].
+
+    The random number streams of the replicates are derived from the root
+    seed and (ids[i], ids[j], N, n).
+
+    If a tolerance is given, processes are run in batches and stop once the
+    Wilson interval of the fixation probability is narrower than the
+    tolerance: the counts then add up to the number of processes run.
+
+    The engine is either "count", playing the repetitions one after the
+    other, "batch", playing them all at once as arrays, or "exact", writing
+    the expected number of wins from the exact fixation probability. The
+    exact engine falls back to the batch engine when the outcome
+    distributions are too wide to be solved exactly.
+
+    With the count and batch engines, pairs whose matches all have a single
+    outcome are not simulated: whether each replicate fixes is sampled from
+    the exact fixation probability.
+    """
+    key = (ids[i], ids[j], N, n)
+    s1 = str(players[i])
+    s2 = str(players[j])
 
     # Pull out just the interaction we need
-    outcomes = dict()
-    for pair in [(s1, s1), (s1, s2), (s2, s1), (s2, s2)]:
-        outcomes[pair] = match_outcomes[pair]
+    distributions = two_type_distributions(match_outcomes, s1, s2)
+
+    wins = None
+    fixation = None
+    if engine == "exact":
+        fixation = exact_fixation(s1, s2, N)
+        if fixation is not None:
+            # Rounded on the cumulative count of replicates, so that the wins
+            # of a seed range do not depend on how it is split
+            p = fixation[n - 1]
+            wins = (int(round((start + repetitions) * p)) -
+                    int(round(start * p)))
+            fixation = None
+        else:
+            # Too expensive to solve exactly
+            engine = "batch"
+    elif is_deterministic(distributions):
+        # The fixation probability is cheap to solve exactly: only sample
+        # the number of wins
+        fixation = exact_fixation(s1, s2, N)
+        if fixation is not None:
+            fixation = fixation[n - 1]
+
+    if wins is None and tolerance is not None:
+        wins, repetitions = adaptive_fixation_wins(distributions, N, n,
+                                                   repetitions, tolerance,
+                                                   batch_size, engine, start,
+                                                   fixation, key, root_seed)
+    elif wins is None:
+        wins = fixation_wins(distributions, N, n, repetitions, engine, start,
+                             fixation, key, root_seed)
+
+    return [[ids[i], ids[j], ids[i], wins],
+            [ids[i], ids[j], ids[j], repetitions - wins]]
 
-    mp = ApproximateMoranProcess(initial_population, cached_outcomes=outcomes)
 
-    data = {i: 0, j: 0}
-    for seed in range(repetitions):
-        axl.seed(seed)
-        mp.reset()
-        mp.play()
-        winner_name = mp.winning_strategy_name
-        data[names_inv[winner_name]] += 1
+def equivalence_classes(keys, N):
+    """
+    Split (i, j, n) keys, n players of type i and N - n players of type j,
+    into classes of identical Moran processes: (i, j, n) is the same process
+    as (j, i, N - n).
+
+    Returns a dictionary mapping the first key of every class to its members.
+    """
+    classes = {}
+    representatives = {}
+    for i, j, n in keys:
+        representative = representatives.setdefault((j, i, N - n), (i, j, n))
+        representatives[(i, j, n)] = representative
+        classes.setdefault(representative, []).append((i, j, n))
+    return classes
+
+
+def simulate_class(ids, N, members, repetitions, engine="count",
+                   start=0, written=None, tolerance=None, batch_size=100,
+                   root_seed=0):
+    """
+    Return the rows [i, j, winner, count] of the members (i, j, n) in written
+    (all of them by default) of a class of identical Moran processes,
+    simulating the first member once.
+    """
+    i, j, n = members[0]
+    rows = simulate_winner(ids, N, i, j, repetitions, n, engine, start,
+                           tolerance, batch_size, root_seed)
+    if written is None:
+        written = members
+    return [[ids[a], ids[b], winner, count]
+            for a, b, _ in written for _, _, winner, count in rows]
+
 
+def write_winner(outfilename, ids,
+                 N, i, j, repetitions, n=1, engine="count"):
+    """
+    Write the winner of a Moran process to file
+    """
+    rows = simulate_winner(ids, N, i, j, repetitions, n, engine)
     path = Path("../data")
     path = path / outfilename
     with path.open('a') as f:
         outputfile = csv.writer(f)
-        for winner, count in data.items():
-            outputfile.writerow([i, j, winner, count])
+        outputfile.writerows(rows)
 
 
 def run_simulations(N=2, repetitions=1000, outfilename=None,
-                    processes=None, count=False, n=1):
+                    processes=None, count=False, n=1, engine="count",
+                    tolerance=None, queue=None, ids=None, root_seed=0):
     """This function conducts many moran processes to empirically estimate
     fixation probabilities. For each pair of strategies, the population consists
-    of n player of the first type and N-n players of the second type."""
+    of n player of the first type and N-n players of the second type.
+
+    If processes is not None, the pairs are simulated by a pool of that many
+    processes (all available cpus if 0), the most expensive first, and the
+    seed ranges of expensive pairs are split across processes. If a queue
+    directory is given, the pairs are simulated by the workers of that queue
+    instead (see `work_queue.py` and `work`).
+
+    Players are written, and recorded in the progress index, as their ids in
+    the registry: ids[i] for players[i] (their positions by default).
+
+    The ranges of replicates simulated are recorded in a progress index next
+    to the output file. If count is True, only the replicates not yet
+    simulated are run. Every replicate has its own random number stream,
+    derived from the root seed, so the results do not depend on the number
+    of processes or on how the runs were interrupted.
+
+    When n = N / 2, the processes for (i, j) and (j, i) are identical: they
+    are simulated once and written for both pairs, or only for the pair
+    missing a seed range when their completed ranges differ.
+
+    The engine used by simulate_winner is either "count", "batch" or
+    "exact". If a tolerance is given, each pair is simulated until the Wilson
+    interval of its fixation probability is narrower than the tolerance, with
+    at most `repetitions` processes."""
     if not outfilename:
         outfilename = "sims_{N}.csv".format(N=N)
 
-    # Obtain current count of obtained values
+    path = Path("../data") / outfilename
+
+    # The seed ranges already simulated for each (i, j, N, n)
+    index = progress.ProgressIndex(progress.progress_filename(path),
+                                   str(path))
     if count is True:
+        index.synchronise(str(path))
+    ranges = index.ranges()
+
+    # Obtain current count of obtained values
+    if count is True and not ranges:
         try:
-            counts = obtain_current_count("../data/" + outfilename)
+            results.repair(str(path))
+            counts = obtain_current_count(str(path))
+            # Output written before the progress index was kept
+            index.record([((i, j, N, n), 0, c)
+                          for (i, j), c in counts.items()],
+                         path.stat().st_size)
+            ranges = index.ranges()
         except OSError:
             # If file does not exist then don't count
-            count = False
+            pass
+    if count is False:
+        ranges = {}
 
-    # Cache names to reverse winners to ids later
-    names_inv = dict(zip([str(p) for p in players], range(len(players))))
+    if ids is None:
+        ids = list(range(len(players)))
+    positions = {id: i for i, id in enumerate(ids)}
 
     player_indices = range(len(players))
-    if processes is None:
-        for i in player_indices:
-            for j in player_indices:
-
-                    if i != j:
-
-                        if count is True:
-                            reps = repetitions - counts.get((i, j), 0)
-                        else:
-                            reps = repetitions
-
-                        if reps > 0:
-                            write_winner(outfilename, names_inv, N, i, j, reps)
-    else:
-        if processes == 0:
-            processes = multiprocessing.cpu_count()
-        func = functools.partial(write_winner, outfilename,
-                                 names_inv, N)
-        p = multiprocessing.Pool(processes)
-
-        player_index_pairs = [(i, j)
-                              for i, j in itertools.product(player_indices,
-                                                            player_indices)
-                              if i != j]
-        if count is True:
-            reps = [repetitions - counts.get(pair, 0)
-                    for pair in player_index_pairs]
-        else:
-            reps = [repetitions for pair in player_index_pairs]
-        args = (pair + (reps[i], n) for i, pair in enumerate(player_index_pairs)
-                if reps[i] > 0)
-        p.starmap(func, args)
+    player_index_pairs = [(i, j)
+                          for i, j in itertools.product(player_indices,
+                                                        player_indices)
+                          if i != j]
+    classes = {(ids[i], ids[j], N, m): members
+               for (i, j, m), members in equivalence_classes(
+                   [(i, j, n) for i, j in player_index_pairs], N).items()}
+    # The members of a class are simulated together, and written for the
+    # members missing each seed range
+    segments = {key: progress.remaining_members(
+                    [ranges.get((ids[i], ids[j], N, m), [])
+                     for i, j, m in members], repetitions)
+                for key, members in classes.items()}
+    tasks = [(key, start, stop)
+             for key, key_segments in segments.items()
+             for start, stop, _ in key_segments]
+    if processes is not None or queue is not None:
+        # Dispatch the most expensive classes first. With a tolerance, a
+        # task must run its whole seed range to stop early. Seed ranges are
+        # split along the blocks of replicates of the batch engine.
+        costs = schedule.costs(
+            tasks, lambda key: schedule.moran_cost(
+                players[positions[key[0]]], players[positions[key[1]]], N),
+            index.timings())
+        tasks = schedule.schedule(tasks, costs, processes,
+                                  min_size=streams.BLOCK_SIZE,
+                                  split=tolerance is None,
+                                  align=streams.BLOCK_SIZE)
+    args = ((classes[key], stop - start, engine, start,
+             [classes[key][k]
+              for k in next(missing for a, b, missing in segments[key]
+                            if a <= start < b)])
+            for key, start, stop in tasks)
+
+    # Only this process writes to the output file. A task completes its whole
+    # seed range, even when it stops early for a tolerance.
+    func = functools.partial(simulate_class, ids, N, tolerance=tolerance,
+                             root_seed=root_seed)
+    results.write_results(func, args, str(path), processes=processes,
+                          progress=index,
+                          record=lambda task: [((ids[i], ids[j], N, m),
+                                                task[3],
+                                                task[3] + task[1])
+                                               for i, j, m in task[4]],
+                          queue=queue)
+    index.close()
 
-def main():
-    N = int(sys.argv[1])  # Population size
+
+def work(queue):
+    """Simulate the pairs put in a queue by run_simulations."""
+    return work_queue.work(queue, {"simulate_class": simulate_class})
+
+
+def pop_option(args, name):
+    """Remove an option `name <value>` from a list of arguments and return
+    its value, None if it is not given."""
+    if name not in args:
+        return None
+    k = args.index(name)
+    value = args[k + 1]
+    del args[k:k + 2]
+    return value
+
+
+def main(args, queue=None):
+    """Run the simulations of the command line arguments, without options."""
+    if args[0] == "worker":
+        work(args[1])
+        return
+
+    N = int(args[0])  # Population size
 
     try:
-        n = int(sys.argv[2])  # Initial population (n, N - n)
+        n = int(args[1])  # Initial population (n, N - n)
     except IndexError:
         n = 1
 
     try:
-        outfilename = sys.argv[4]
+        outfilename = args[3]
     except IndexError:
         outfilename = None
 
+    try:
+        engine = args[4]  # "count", "batch" or "exact"
+    except IndexError:
+        engine = "count"
+
+    try:
+        tolerance = float(args[5])  # Width of the fixation interval
+    except IndexError:
+        tolerance = None
+
     repetitions = 1000
     # Make sure the data folder exists
     path = Path("../data")
     path.mkdir(exist_ok=True)
 
-    output_players(players)
+    ids = output_players(players)
 
     run_simulations(N=N, repetitions=repetitions, processes=0, count=True,
-                    outfilename=outfilename, n=n)
+                    outfilename=outfilename, n=n, engine=engine,
+                    tolerance=tolerance, queue=queue, ids=ids)
 
 if __name__ == "__main__":
     # match_outcomes and players are global
-    # Run with `python moran.py <N> <n> <outcome_file> <filename>`
+    # Run with
+    # `python moran.py <N> <n> <outcome_file> <filename> <engine> [<tolerance>]
+    #  [--queue <queue>]`
+    # and the workers of a queue with
+    # `python moran.py worker <queue> <outcome_file>`
+    args = sys.argv[1:]
+    queue = pop_option(args, "--queue")  # Directory shared with the workers
     try:
-        match_outcomes_file = sys.argv[3]
+        match_outcomes_file = args[2]
     except IndexError:
         match_outcomes_file = "../data/outcomes.csv"
 
-    match_outcomes = read_csv(match_outcomes_file)
-    for k, v in match_outcomes.items():
-        match_outcomes[k] = Pdf(v)
+    match_outcomes = read_outcomes(match_outcomes_file)
 
     # players are global
     from players import selected_players
     players = selected_players()
 
-    main()
+    main(args, queue)
 
 
 #########
@@ -186,20 +635,43 @@ if __name__ == "__main__":
 #########
 
 
+def build_population(players, i, j, weights):
+    """Return the population of strategies according to a given weights"""
+    sub_players = players[i], players[j]
+    population = []
+    for player, weight in zip(sub_players, weights):
+        for _ in range(weight):
+            population.append(player.clone())
+    return population
+
+
+class Test_pop_option(unittest.TestCase):
+    def test_pop_option(self):
+        args = ["4", "1", "--queue", "../queue", "outcomes.csv"]
+        self.assertEqual(pop_option(args, "--queue"), "../queue")
+        self.assertEqual(args, ["4", "1", "outcomes.csv"])
+        self.assertIsNone(pop_option(args, "--queue"))
+
+
 class Test_output_players(unittest.TestCase):
     """Test the output players function"""
     def test_output(self):
         outfile = tempfile.NamedTemporaryFile('w')
         players = [s() for s in axl.demo_strategies]
-        output_players(players, outfile.name)
-        with open(outfile.name, 'r') as outfile:
-            test_output = [row for row in csv.reader(outfile)]
+        self.assertEqual(output_players(players, outfile.name),
+                         [0, 1, 2, 3, 4])
+        with open(outfile.name, 'r') as f:
+            test_output = [row[:3] for row in csv.reader(f)]
         expected_output = [['0', 'Cooperator', 'False'],
                            ['1', 'Defector', 'False'],
                            ['2', 'Tit For Tat', 'False'],
                            ['3', 'Grudger', 'False'],
                            ['4', 'Random: 0.5', 'True']]
         self.assertEqual(test_output, expected_output)
+        # Players keep their ids when reordered
+        self.assertEqual(output_players(players[::-1], outfile.name),
+                         [4, 3, 2, 1, 0])
+        outfile.close()
 
 
 class Test_build_population(unittest.TestCase):
@@ -248,10 +720,363 @@ class Test_write_winner(unittest.TestCase):
     match_outcomes[('Defector', 'Defector')] = pdf
 
     temp_file = tempfile.NamedTemporaryFile()
-    names_inv = {"Cooperator": 0, "Defector": 1}
+    ids = [0, 1]
 
     def test_write_winner(self):
-        write_winner(self.temp_file.name, self.names_inv, 2, 0, 1, 10)
+        write_winner(self.temp_file.name, self.ids, 2, 0, 1, 10)
         df = pd.read_csv(self.temp_file.name, header=None)
-        self.assertEqual(list(df.ix[:, 3]), [0, 10])
+        self.assertEqual(list(df.iloc[:, 3]), [0, 10])
         self.temp_file.close()
+
+
+class Test_fixation_count(unittest.TestCase):
+    """Test the two type Moran process engine"""
+    outcomes = {("Cooperator", "Cooperator"): Pdf(collections.Counter([(3, 3)])),
+                ("Cooperator", "Defector"): Pdf(collections.Counter([(0, 5)])),
+                ("Defector", "Cooperator"): Pdf(collections.Counter([(5, 0)])),
+                ("Defector", "Defector"): Pdf(collections.Counter([(1, 1)]))}
+
+    def test_population_fitness(self):
+        distributions = two_type_distributions(self.outcomes, "Cooperator",
+                                               "Defector")
+        self.assertEqual(population_fitness(distributions, 4, 1), (0, 21))
+        self.assertEqual(population_fitness(distributions, 4, 3), (18, 15))
+
+    def test_fixation_count(self):
+        distributions = two_type_distributions(self.outcomes, "Cooperator",
+                                               "Defector")
+        for seed in range(10):
+            axl.seed(seed)
+            self.assertFalse(fixation_count(distributions, 2, 1))
+        self.assertTrue(fixation_count(distributions, 5, 5))
+        self.assertFalse(fixation_count(distributions, 5, 0))
+
+    def test_matches_approximate_moran_process(self):
+        outcomes = {("Alternator", "Alternator"): Pdf(collections.Counter([(2, 2)])),
+                    ("Alternator", "Random: 0.5"): Pdf(collections.Counter({(1, 4): 1, (3, 2): 3})),
+                    ("Random: 0.5", "Alternator"): Pdf(collections.Counter({(4, 1): 1, (2, 3): 3})),
+                    ("Random: 0.5", "Random: 0.5"): Pdf(collections.Counter({(2, 2): 1, (1, 3): 1}))}
+        distributions = two_type_distributions(outcomes, "Alternator",
+                                               "Random: 0.5")
+        population = [axl.Alternator(), axl.Random(), axl.Random(),
+                      axl.Random()]
+        mp = ApproximateMoranProcess(population, cached_outcomes=outcomes)
+        repetitions = 500
+        simulated, engine = 0, 0
+        for seed in range(repetitions):
+            axl.seed(seed)
+            mp.reset()
+            mp.play()
+            simulated += mp.winning_strategy_name == "Alternator"
+            engine += fixation_count(distributions, 4, 1)
+        self.assertAlmostEqual(simulated / repetitions, engine / repetitions,
+                               delta=0.08)
+
+
+class Test_batch_fixation(unittest.TestCase):
+    """Test the vectorised two type Moran process engine"""
+    outcomes = Test_fixation_count.outcomes
+
+    def test_batch_population_fitness(self):
+        distributions = two_type_distributions(self.outcomes, "Cooperator",
+                                               "Defector")
+        rng = np.random.default_rng(0)
+        first, second = batch_population_fitness(distributions, 4,
+                                                 np.array([1, 3]), rng)
+        self.assertEqual(list(first), [0, 18])
+        self.assertEqual(list(second), [21, 15])
+
+    def test_batch_fixation(self):
+        distributions = two_type_distributions(self.outcomes, "Cooperator",
+                                               "Defector")
+        fixed = batch_fixation(distributions, 2, 1, 50)
+        self.assertEqual(fixed.shape, (50,))
+        self.assertFalse(fixed.any())
+        self.assertTrue(batch_fixation(distributions, 5, 5, 10).all())
+
+    def test_matches_fixation_count(self):
+        distributions = two_type_distributions(self.outcomes, "Defector",
+                                               "Cooperator")
+        repetitions = 2000
+        batch = batch_fixation(distributions, 6, 2, repetitions).mean()
+        count = 0
+        for seed in range(repetitions):
+            axl.seed(seed)
+            count += fixation_count(distributions, 6, 2)
+        self.assertAlmostEqual(batch, count / repetitions, delta=0.05)
+
+
+class Test_visit_fixation(unittest.TestCase):
+    """Test the estimates of fixation from every visited state"""
+    outcomes = Test_fixation_count.outcomes
+
+    def test_visit_fixation_wins(self):
+        distributions = two_type_distributions(self.outcomes, "Defector",
+                                               "Cooperator")
+        visits, wins = visit_fixation_wins(distributions, 6, 3, 250,
+                                           key=(1, 0, 6, 3))
+        self.assertEqual(visits[3], 250)
+        self.assertEqual(visits[6], wins[6])
+        self.assertEqual(wins[0], 0)
+        self.assertEqual(wins[3],
+                         fixation_wins(distributions, 6, 3, 250, "batch",
+                                       key=(1, 0, 6, 3)))
+        # Independent of how the replicates are split
+        first = visit_fixation_wins(distributions, 6, 3, 130,
+                                    key=(1, 0, 6, 3))
+        second = visit_fixation_wins(distributions, 6, 3, 120, start=130,
+                                     key=(1, 0, 6, 3))
+        np.testing.assert_array_equal(visits, first[0] + second[0])
+        np.testing.assert_array_equal(wins, first[1] + second[1])
+
+    def test_matches_exact_fixation(self):
+        pair = ("Defector", "Cooperator")
+        distributions = two_type_distributions(self.outcomes, *pair)
+        fixation = theoretic.outcome_fixation(pair, 6, self.outcomes)
+        estimates = visit_fixation(distributions, 6, 3, 4000)
+        self.assertEqual(estimates.shape, (5,))
+        np.testing.assert_allclose(estimates, fixation, atol=0.04)
+
+
+class Test_exact_engine(unittest.TestCase):
+    """Test the exact engine against the simulations"""
+    outcomes = Test_fixation_count.outcomes
+
+    def test_matches_batch_fixation(self):
+        pair = ("Defector", "Cooperator")
+        distributions = two_type_distributions(self.outcomes, *pair)
+        fixation = theoretic.outcome_fixation(pair, 6, self.outcomes)
+        for n in [1, 3, 5]:
+            batch = batch_fixation(distributions, 6, n, 4000).mean()
+            self.assertAlmostEqual(batch, fixation[n - 1], delta=0.03)
+
+    def test_zero_fitness(self):
+        # Outcomes with a total fitness of zero: the first type reproduces
+        # in both the exact solver and the simulations
+        outcomes = {("A", "A"): Pdf(collections.Counter([(0, 0)])),
+                    ("A", "B"): Pdf(collections.Counter([(0, 0), (2, 1)])),
+                    ("B", "A"): Pdf(collections.Counter([(0, 0), (1, 2)])),
+                    ("B", "B"): Pdf(collections.Counter([(1, 1)]))}
+        distributions = two_type_distributions(outcomes, "A", "B")
+        fixation = theoretic.outcome_fixation(("A", "B"), 3, outcomes)
+        for n in [1, 2]:
+            batch = batch_fixation(distributions, 3, n, 8000).mean()
+            self.assertAlmostEqual(batch, fixation[n - 1], delta=0.02)
+
+    def test_split_seed_ranges(self):
+        global players, match_outcomes
+        saved = players, match_outcomes
+        players = ["A", "B"]
+        match_outcomes = {
+            ("A", "A"): Pdf(collections.Counter([(0, 0)])),
+            ("A", "B"): Pdf(collections.Counter([(0, 0), (2, 1)])),
+            ("B", "A"): Pdf(collections.Counter([(0, 0), (1, 2)])),
+            ("B", "B"): Pdf(collections.Counter([(1, 1)]))}
+        try:
+            whole = simulate_winner([0, 1], 3, 0, 1, 10, engine="exact")
+            split = sum(simulate_winner([0, 1], 3, 0, 1, 1, engine="exact",
+                                        start=k)[0][3] for k in range(10))
+            self.assertEqual(split, whole[0][3])
+            fixation = exact_fixation("A", "B", 3)
+            self.assertEqual(whole[0][3], int(round(10 * fixation[0])))
+            # Solved once for the same outcomes, again for others
+            self.assertIs(exact_fixation("A", "B", 3), fixation)
+            self.assertIsNot(exact_fixation("A", "B", 3,
+                                            dict(match_outcomes)), fixation)
+        finally:
+            players, match_outcomes = saved
+
+    def test_write_winner(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        write_winner(temp_file.name, Test_write_winner.ids, 2, 0, 1,
+                     10, engine="exact")
+        df = pd.read_csv(temp_file.name, header=None)
+        self.assertEqual(list(df.iloc[:, 3]), [0, 10])
+        temp_file.close()
+
+
+class Test_run_simulations(unittest.TestCase):
+    """Test that all pairs are simulated and written to file"""
+    def test_run_simulations(self):
+        for processes in [None, 2]:
+            with tempfile.TemporaryDirectory() as directory:
+                outfilename = directory + "/sims_3.csv"
+                run_simulations(N=3, repetitions=10, outfilename=outfilename,
+                                processes=processes)
+                df = pd.read_csv(outfilename, header=None)
+                self.assertEqual(len(df), 4)
+                self.assertEqual(obtain_current_count(outfilename),
+                                 {(0, 1): 10, (1, 0): 10})
+                # Only the missing repetitions are run, with new seeds
+                run_simulations(N=3, repetitions=15, outfilename=outfilename,
+                                processes=processes, count=True)
+                self.assertEqual(obtain_current_count(outfilename),
+                                 {(0, 1): 15, (1, 0): 15})
+                index = progress.ProgressIndex(
+                    progress.progress_filename(outfilename))
+                self.assertEqual(index.ranges(),
+                                 {(0, 1, 3, 1): [(0, 10), (10, 15)],
+                                  (1, 0, 3, 1): [(0, 10), (10, 15)]})
+
+    def test_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outfilename = directory + "/sims_4.csv"
+            queue = directory + "/queue"
+            work_queue.clear(queue)
+            worker = multiprocessing.Process(target=work, args=(queue,))
+            worker.start()
+            run_simulations(N=4, repetitions=10, outfilename=outfilename,
+                            n=2, queue=queue)
+            worker.join()
+            counts = obtain_current_count(outfilename)
+            self.assertEqual(counts, {(0, 1): 10, (1, 0): 10})
+
+    def test_resume_without_progress_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outfilename = directory + "/sims_3.csv"
+            with open(outfilename, "w") as f:
+                f.write("0,1,0,0\n0,1,1,4\n1,0,0,1\n1,0,1,")
+            run_simulations(N=3, repetitions=5, outfilename=outfilename,
+                            count=True)
+            self.assertEqual(obtain_current_count(outfilename),
+                             {(0, 1): 5, (1, 0): 5})
+            index = progress.ProgressIndex(
+                progress.progress_filename(outfilename))
+            self.assertEqual(index.ranges(),
+                             {(0, 1, 3, 1): [(0, 4), (4, 5)],
+                              (1, 0, 3, 1): [(0, 1), (1, 5)]})
+
+    def test_resume_uneven_class(self):
+        # At n = N / 2 the two pairs are simulated together, but a legacy
+        # file may hold different counts for each
+        for legacy, repetitions, expected in [
+                ("0,1,0,2\n0,1,1,3\n1,0,0,1\n1,0,1,1\n", 5,
+                 {(0, 1): 5, (1, 0): 5}),
+                ("0,1,0,2\n0,1,1,3\n1,0,0,4\n1,0,1,4\n", 5,
+                 {(0, 1): 5, (1, 0): 8}),
+                ("0,1,0,2\n0,1,1,3\n1,0,0,4\n1,0,1,4\n", 10,
+                 {(0, 1): 10, (1, 0): 10})]:
+            for processes in [None, 2]:
+                with tempfile.TemporaryDirectory() as directory:
+                    outfilename = directory + "/sims_4.csv"
+                    with open(outfilename, "w") as f:
+                        f.write(legacy)
+                    run_simulations(N=4, repetitions=repetitions,
+                                    outfilename=outfilename, n=2,
+                                    count=True, processes=processes)
+                    self.assertEqual(obtain_current_count(outfilename),
+                                     expected)
+
+
+class Test_adaptive_fixation_wins(unittest.TestCase):
+    """Test the sequential stopping of simulations"""
+    def test_wilson_interval(self):
+        lower, upper = wilson_interval(0, 10)
+        self.assertAlmostEqual(lower, 0)
+        self.assertAlmostEqual(upper, 0.2775, places=4)
+        lower, upper = wilson_interval(50, 100)
+        self.assertAlmostEqual(lower, 0.4038, places=4)
+        self.assertAlmostEqual(upper, 0.5962, places=4)
+
+    def test_adaptive_fixation_wins(self):
+        distributions = two_type_distributions(Test_fixation_count.outcomes,
+                                               "Cooperator", "Defector")
+        self.assertEqual(adaptive_fixation_wins(distributions, 2, 1, 1000,
+                                                tolerance=0.2, batch_size=20),
+                         (0, 20))
+        self.assertEqual(adaptive_fixation_wins(distributions, 2, 1, 50,
+                                                tolerance=0.01, batch_size=20),
+                         (0, 50))
+
+    def test_simulate_winner(self):
+        rows = simulate_winner(Test_write_winner.ids, 2, 0, 1, 1000,
+                               tolerance=0.05, engine="batch")
+        self.assertEqual(rows, [[0, 1, 0, 0], [0, 1, 1, 100]])
+
+
+class Test_deterministic_pairs(unittest.TestCase):
+    """Test the sampling of wins for pairs with a single outcome per match"""
+    def test_is_deterministic(self):
+        distributions = two_type_distributions(Test_fixation_count.outcomes,
+                                               "Cooperator", "Defector")
+        self.assertTrue(is_deterministic(distributions))
+        outcomes = Test_fixation_count.outcomes.copy()
+        outcomes[("Cooperator", "Defector")] = Pdf(
+            collections.Counter({(0, 5): 1, (1, 4): 1}))
+        distributions = two_type_distributions(outcomes, "Cooperator",
+                                               "Defector")
+        self.assertFalse(is_deterministic(distributions))
+
+    def test_fixation_wins(self):
+        self.assertEqual(fixation_wins(None, 5, 2, 100, fixation=0), 0)
+        self.assertEqual(fixation_wins(None, 5, 2, 100, fixation=1), 100)
+        wins = fixation_wins(None, 5, 2, 10000, fixation=0.3)
+        self.assertAlmostEqual(wins / 10000, 0.3, delta=0.02)
+        self.assertEqual(wins, fixation_wins(None, 5, 2, 10000, fixation=0.3))
+
+    def test_simulate_winner(self):
+        fixation = theoretic.outcome_fixation(("Defector", "Cooperator"), 5,
+                                              Test_fixation_count.outcomes)
+        distributions = two_type_distributions(Test_fixation_count.outcomes,
+                                               "Defector", "Cooperator")
+        simulated = fixation_wins(distributions, 5, 2, 2000) / 2000
+        rows = simulate_winner([0, 1], 5, 1, 0, 2000, n=2)
+        self.assertEqual(rows[0][:3], [1, 0, 1])
+        self.assertAlmostEqual(rows[0][3] / 2000, fixation[1], delta=0.03)
+        self.assertAlmostEqual(simulated, fixation[1], delta=0.03)
+
+
+class Test_equivalence_classes(unittest.TestCase):
+    """Test the grouping of identical Moran processes"""
+    def test_equivalence_classes(self):
+        keys = [(0, 1, 1), (1, 0, 1), (0, 1, 2), (1, 0, 2), (0, 2, 2),
+                (1, 0, 3)]
+        self.assertEqual(equivalence_classes(keys, 4),
+                         {(0, 1, 1): [(0, 1, 1), (1, 0, 3)],
+                          (1, 0, 1): [(1, 0, 1)],
+                          (0, 1, 2): [(0, 1, 2), (1, 0, 2)],
+                          (0, 2, 2): [(0, 2, 2)]})
+        self.assertEqual(equivalence_classes([(0, 1, 1), (1, 0, 1)], 2),
+                         {(0, 1, 1): [(0, 1, 1), (1, 0, 1)]})
+
+    def test_simulate_class(self):
+        rows = simulate_class([0, 1], 4, [(0, 1, 2), (1, 0, 2)], 100)
+        wins = rows[0][3]
+        self.assertEqual(rows, [[0, 1, 0, wins], [0, 1, 1, 100 - wins],
+                                [1, 0, 0, wins], [1, 0, 1, 100 - wins]])
+        # Players are written as their ids
+        rows = simulate_class([7, 3], 4, [(0, 1, 2), (1, 0, 2)], 100)
+        self.assertEqual([row[:3] for row in rows],
+                         [[7, 3, 7], [7, 3, 3], [3, 7, 7], [3, 7, 3]])
+        # Only the members written
+        rows = simulate_class([7, 3], 4, [(0, 1, 2), (1, 0, 2)], 100,
+                              written=[(1, 0, 2)])
+        self.assertEqual([row[:3] for row in rows], [[3, 7, 7], [3, 7, 3]])
+
+
+class Test_random_streams(unittest.TestCase):
+    """Test that the replicates do not depend on how ranges are split"""
+    outcomes = {("Alternator", "Alternator"): Pdf(collections.Counter([(2, 2)])),
+                ("Alternator", "Random: 0.5"): Pdf(collections.Counter({(1, 4): 1, (3, 2): 3})),
+                ("Random: 0.5", "Alternator"): Pdf(collections.Counter({(4, 1): 1, (2, 3): 3})),
+                ("Random: 0.5", "Random: 0.5"): Pdf(collections.Counter({(2, 2): 1, (1, 3): 1}))}
+
+    def test_split_ranges(self):
+        distributions = two_type_distributions(self.outcomes, "Alternator",
+                                               "Random: 0.5")
+        for engine, fixation in [("count", None), ("batch", None),
+                                 ("count", 0.4)]:
+            whole = fixation_wins(distributions, 4, 1, 250, engine,
+                                  fixation=fixation, key=(0, 1, 4, 1))
+            split = sum(fixation_wins(distributions, 4, 1, stop - start,
+                                      engine, start, fixation,
+                                      key=(0, 1, 4, 1))
+                        for start, stop in [(0, 30), (30, 170), (170, 250)])
+            self.assertEqual(whole, split)
+            # Other keys and root seeds give other streams
+            others = [fixation_wins(distributions, 4, 1, 250, engine,
+                                    fixation=fixation, key=(1, 0, 4, 3)),
+                      fixation_wins(distributions, 4, 1, 250, engine,
+                                    fixation=fixation, key=(0, 1, 4, 1),
+                                    root_seed=1)]
+            self.assertNotEqual(others, [whole, whole])
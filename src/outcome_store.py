@@ -0,0 +1,369 @@
+"""
+A binary columnar store of match outcomes.
+
+A store is a directory holding:
+
+- `players.csv`: the integer id and name of every player;
+- `pairs.npy`: one row (player 1 id, player 2 id, start, stop) per pair of
+  players, where start and stop delimit the outcomes of that pair in:
+- `scores.npy`: the (player 1 score, player 2 score) of every outcome;
+- `counts.npy`: the number of times each outcome occurred.
+
+The arrays are memory mapped when the store is opened, the outcomes of a pair
+are only read when that pair is requested.
+"""
+from collections import Counter, OrderedDict
+import csv
+import fcntl
+from pathlib import Path
+import os
+import shutil
+import sys
+import tempfile
+
+import axelrod as axl
+import numpy as np
+import pandas as pd
+
+import generate_cache
+
+# For tests
+import multiprocessing
+import pickle
+import unittest
+
+
+def write_store(outcomes, directory):
+    """
+    Write a dictionary mapping pairs of player names to counters of outcomes
+    (as written by generate_cache.write_csv) to a store.
+    """
+    rows = [(pair[0], pair[1], scores[0], scores[1], count)
+            for pair, counter in outcomes.items()
+            for scores, count in counter.items()]
+    df = pd.DataFrame(rows, columns=["Player 1", "Player 2",
+                                     "Score 1", "Score 2", "Count"])
+    write_frame(df, directory)
+
+
+def csv_to_store(filename, directory):
+    """Convert an outcomes csv file (as written by generate_cache) to a store"""
+    df = pd.read_csv(filename, header=None,
+                     names=["Player 1", "Player 2",
+                            "Score 1", "Score 2", "Count"],
+                     float_precision="round_trip")
+    write_frame(df, directory)
+
+
+def write_frame(df, directory):
+    """Write a data frame of outcomes, one row per outcome, to a store."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    names = pd.unique(pd.concat([df["Player 1"], df["Player 2"]]))
+    ids = pd.Series(np.arange(len(names)), index=names)
+    id1 = ids[df["Player 1"]].values
+    id2 = ids[df["Player 2"]].values
+    score1 = df["Score 1"].values.astype(float)
+    score2 = df["Score 2"].values.astype(float)
+
+    # Store every pair once, with the smallest id first
+    swap = id1 > id2
+    id1, id2 = np.where(swap, id2, id1), np.where(swap, id1, id2)
+    score1, score2 = np.where(swap, score2, score1), np.where(swap, score1,
+                                                             score2)
+    frame = pd.DataFrame({"id1": id1, "id2": id2,
+                          "score1": score1, "score2": score2,
+                          "count": df["Count"].values.astype(np.int64)})
+    # As with generate_cache.read_csv, the last count of an outcome is kept
+    frame = frame.drop_duplicates(["id1", "id2", "score1", "score2"],
+                                  keep="last")
+    frame = frame.sort_values(["id1", "id2"], kind="mergesort")
+
+    pair_ids = frame[["id1", "id2"]].values
+    if len(pair_ids) > 0:
+        new_pair = np.ones(len(pair_ids), dtype=bool)
+        new_pair[1:] = (pair_ids[1:] != pair_ids[:-1]).any(axis=1)
+        starts = np.flatnonzero(new_pair)
+    else:
+        starts = np.zeros(0, dtype=np.int64)
+    stops = np.append(starts[1:], len(pair_ids))
+    pairs = np.column_stack([pair_ids[starts], starts, stops]).astype(np.int64)
+
+    with (directory / "players.csv").open("w") as f:
+        writer = csv.writer(f)
+        writer.writerows(enumerate(names))
+    np.save(str(directory / "pairs.npy"), pairs.reshape(-1, 4))
+    np.save(str(directory / "scores.npy"),
+            frame[["score1", "score2"]].values.reshape(-1, 2))
+    np.save(str(directory / "counts.npy"), frame["count"].values)
+
+
+class OutcomeStore(object):
+    """
+    Read only access to a store of match outcomes.
+
+    Behaves as the dictionary returned by generate_cache.read_csv with every
+    counter turned in to an axelrod.Pdf: a pair of player names, in either
+    order, gives the distribution of their match outcomes. The distributions
+    are built when requested and the `maxsize` most recently used ones are
+    kept.
+    """
+    def __init__(self, directory, mmap_mode="r", maxsize=128):
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+        self.maxsize = maxsize
+        directory = Path(directory)
+        # The same for every copy of a store, until the store is replaced
+        self.identity = (str(directory.resolve()),
+                         (directory / "counts.npy").stat().st_mtime_ns)
+        with (directory / "players.csv").open("r") as f:
+            self.players = [name for _, name in csv.reader(f)]
+        self.ids = {name: i for i, name in enumerate(self.players)}
+        # Pairs are sorted by ids, so are their keys
+        self.pairs = np.load(str(directory / "pairs.npy"), mmap_mode=mmap_mode)
+        self.keys = self.pairs[:, 0] * len(self.players) + self.pairs[:, 1]
+        self.scores = np.load(str(directory / "scores.npy"),
+                              mmap_mode=mmap_mode)
+        self.counts = np.load(str(directory / "counts.npy"),
+                              mmap_mode=mmap_mode)
+        self.pdfs = OrderedDict()
+
+    def locate(self, id1, id2):
+        """
+        Return the (start, stop) of the outcomes of a pair of ids, with
+        id1 <= id2. Raises a KeyError if the pair is not in the store.
+        """
+        key = id1 * len(self.players) + id2
+        k = np.searchsorted(self.keys, key)
+        if k == len(self.keys) or self.keys[k] != key:
+            raise KeyError((self.players[id1], self.players[id2]))
+        return int(self.pairs[k, 2]), int(self.pairs[k, 3])
+
+    def counter(self, pair):
+        """Return the counter of outcomes of a pair of player names."""
+        id1, id2 = self.ids[pair[0]], self.ids[pair[1]]
+        reverse = id1 > id2
+        start, stop = self.locate(*sorted((id1, id2)))
+        counter = Counter()
+        for (s1, s2), count in zip(self.scores[start:stop].tolist(),
+                                   self.counts[start:stop].tolist()):
+            if reverse:
+                s1, s2 = s2, s1
+            counter[(s1, s2)] = count
+            if id1 == id2:
+                counter[(s2, s1)] = count
+        return counter
+
+    def __getitem__(self, pair):
+        try:
+            self.pdfs.move_to_end(pair)
+            return self.pdfs[pair]
+        except KeyError:
+            pdf = axl.Pdf(self.counter(pair))
+            self.pdfs[pair] = pdf
+            if len(self.pdfs) > self.maxsize:
+                self.pdfs.popitem(last=False)
+            return pdf
+
+    def __contains__(self, pair):
+        try:
+            self.locate(*sorted((self.ids[pair[0]], self.ids[pair[1]])))
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __reduce__(self):
+        # Worker processes reopen the memory mapped arrays instead of
+        # receiving a copy of them.
+        return (OutcomeStore, (self.directory, self.mmap_mode, self.maxsize))
+
+
+def same_outcomes(first, second):
+    """
+    Return whether two dictionaries of outcomes are the same object, or
+    copies of the same store.
+    """
+    return first is second or (
+        getattr(first, "identity", None) is not None and
+        first.identity == getattr(second, "identity", None))
+
+
+def read_outcomes(path):
+    """
+    Return an OutcomeStore of match outcomes.
+
+    If path is an outcomes csv file, it is converted once to a store directory
+    next to it (`outcomes.csv` gives `outcomes.store`) which is reused for as
+    long as it is more recent than the csv file.
+
+    Processes reading the same csv file take turns through a lock file
+    (`outcomes.store.lock`): the first converts it, the others open its store.
+    A store is built in a directory of its own and renamed in to place, so a
+    store is never seen half written. An out of date store is renamed to
+    `outcomes.store.old-<suffix>` rather than removed, as other processes may
+    still have it open.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return OutcomeStore(path)
+
+    directory = path.with_suffix(".store")
+    with directory.with_suffix(".store.lock").open("a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_stale(directory, path):
+            replace_store(path, directory)
+        return OutcomeStore(directory)
+
+
+def is_stale(directory, path):
+    """Return whether a store is missing or older than its csv file."""
+    return (not directory.is_dir() or
+            directory.stat().st_mtime < path.stat().st_mtime)
+
+
+def replace_store(path, directory):
+    """
+    Convert a csv file to a new store and rename it to directory, unless
+    another process has put an up to date store there first.
+    """
+    parent = str(directory.parent)
+    temporary = tempfile.mkdtemp(dir=parent, prefix="." + directory.name)
+    csv_to_store(path, temporary)
+    if directory.is_dir():
+        old = tempfile.mkdtemp(dir=parent, prefix=directory.name + ".old-")
+        try:
+            # Replaces the empty directory old
+            os.rename(str(directory), old)
+        except OSError:
+            # Moved by another process
+            os.rmdir(old)
+    try:
+        os.rename(temporary, str(directory))
+    except OSError:
+        # Another process won the race: open its store
+        shutil.rmtree(temporary)
+
+
+if __name__ == "__main__":
+    # Run with `python outcome_store.py <outcome_file> <store_directory>`
+    csv_to_store(sys.argv[1], sys.argv[2])
+
+
+#########
+# Tests #
+#########
+
+
+def read_counter(filename):
+    """Return a counter of outcomes read through read_outcomes"""
+    return read_outcomes(filename).counter(("Defector", "Cooperator"))
+
+
+class TestOutcomeStore(unittest.TestCase):
+    """Test writing and reading a store against the csv files"""
+    outcomes = {("Cooperator", "Cooperator"): Counter({(3, 3): 1}),
+                ("Defector", "Cooperator"): Counter({(5, 0): 1}),
+                ("Random: 0.5", "Cooperator"): Counter({(1.5, 4.0): 3,
+                                                        (2.25, 3.5): 7}),
+                ("Random: 0.5", "Random: 0.5"): Counter({(2.0, 2.5): 4,
+                                                         (2.5, 2.0): 4,
+                                                         (2.25, 2.25): 2}),
+                ("Defector", "Random: 0.5"): Counter({(3.0, 0.5): 6,
+                                                      (2.8, 0.55): 4})}
+
+    def assertMatchesCsv(self, store, filename):
+        expected = generate_cache.read_csv(filename)
+        self.assertEqual(len(store), len(self.outcomes))
+        for pair, counter in expected.items():
+            self.assertIn(pair, store)
+            self.assertEqual(store.counter(pair), counter)
+            pdf = store[pair]
+            self.assertEqual(pdf.sample_space, axl.Pdf(counter).sample_space)
+            self.assertEqual(pdf.probability, axl.Pdf(counter).probability)
+        self.assertNotIn(("Defector", "Defector"), store)
+        self.assertNotIn(("Defector", "Grudger"), store)
+
+    def test_csv_to_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = str(Path(directory) / "outcomes.csv")
+            generate_cache.write_csv(self.outcomes, filename)
+            csv_to_store(filename, Path(directory) / "store")
+            store = OutcomeStore(Path(directory) / "store")
+            self.assertMatchesCsv(store, filename)
+
+    def test_write_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = str(Path(directory) / "outcomes.csv")
+            generate_cache.write_csv(self.outcomes, filename)
+            write_store(self.outcomes, directory)
+            store = OutcomeStore(directory)
+            self.assertMatchesCsv(store, filename)
+            self.assertIs(store[("Defector", "Cooperator")],
+                          store[("Defector", "Cooperator")])
+
+    def test_read_outcomes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = str(Path(directory) / "outcomes.csv")
+            generate_cache.write_csv(self.outcomes, filename)
+            write_store(self.outcomes, directory)
+            self.assertIsInstance(read_outcomes(directory), OutcomeStore)
+
+            store = read_outcomes(filename)
+            self.assertEqual(store.directory, Path(directory) / "outcomes.store")
+            self.assertMatchesCsv(store, filename)
+            # The converted store is reused
+            mtime = (Path(directory) / "outcomes.store").stat().st_mtime
+            read_outcomes(filename)
+            self.assertEqual(
+                (Path(directory) / "outcomes.store").stat().st_mtime, mtime)
+
+            # A newer csv file replaces the store, the old one is kept
+            os.utime(filename, (mtime + 10, mtime + 10))
+            store = read_outcomes(filename)
+            self.assertMatchesCsv(store, filename)
+            self.assertEqual(len([name for name in os.listdir(directory)
+                                  if name.startswith("outcomes.store.old-")]),
+                             1)
+
+    def test_concurrent_read_outcomes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = str(Path(directory) / "outcomes.csv")
+            generate_cache.write_csv(self.outcomes, filename)
+            with multiprocessing.Pool(6) as pool:
+                counters = pool.map(read_counter, [filename] * 6)
+            self.assertEqual(counters, [read_counter(filename)] * 6)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ["outcomes.csv", "outcomes.store",
+                              "outcomes.store.lock"])
+
+    def test_pickle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_store(self.outcomes, directory)
+            store = OutcomeStore(directory)
+            store[("Defector", "Cooperator")]
+            data = pickle.dumps(store)
+            self.assertLess(len(data), 200)
+            copy = pickle.loads(data)
+            self.assertTrue(same_outcomes(copy, store))
+            self.assertFalse(same_outcomes(copy, dict(store.pdfs)))
+            self.assertEqual(copy.counter(("Cooperator", "Random: 0.5")),
+                             store.counter(("Cooperator", "Random: 0.5")))
+
+    def test_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_store(self.outcomes, directory)
+            store = OutcomeStore(directory, maxsize=2)
+            first = store[("Defector", "Cooperator")]
+            second = store[("Cooperator", "Cooperator")]
+            self.assertIs(store[("Defector", "Cooperator")], first)
+            store[("Random: 0.5", "Cooperator")]
+            self.assertEqual(list(store.pdfs),
+                             [("Defector", "Cooperator"),
+                              ("Random: 0.5", "Cooperator")])
+            self.assertIsNot(store[("Cooperator", "Cooperator")], second)
+            with self.assertRaises(KeyError):
+                store[("Defector", "Defector")]
@@ -1,3 +1,5 @@
+import hashlib
+
 import axelrod as axl
 
 axl.Grudger.classifier["memory_depth"] = 1
@@ -70,5 +72,21 @@ def selected_players(extra_players=fsm_players):
 
     return players
 
+def strategy_hash(player):
+    """
+    Return a stable integer hash of the strategy and parameters of a player,
+    independent of its position in selected_players.
+    """
+    identity = repr((type(player).__name__,
+                     sorted(player.init_kwargs.items())))
+    return int(hashlib.sha1(identity.encode()).hexdigest()[:15], 16)
+
+def strategy_id(player):
+    """
+    Return the strategy_hash of a player as the 15 hexadecimal digits that
+    identify it in files and dictionaries.
+    """
+    return "{:015x}".format(strategy_hash(player))
+
 if __name__ == "__main__":
     print(len(selected_players()))
@@ -1,53 +1,51 @@
 """
 A script to write the final format of the data
 """
+from pathlib import Path
+
 import pandas as pd
-import tempfile
-
-def merged_df(N):
-    summary = pd.read_csv("../data/sims_summary.csv")
-    summary = summary[summary["N"] == N]
-
-    columns = [["player", "opponent", "N", "Noise", "$p_1$", "$p_{N/2}$"],
-               ["player", "opponent", "N", "Noise", "$p_{N-1}$"]]
-    dfs = [[], []]
-    for (player, N, opponent, Noise), df in summary.groupby(["P1", "N",
-                                                             "P2", "Noise"]):
-        try:
-            p1 = df[df["i"] == 1].iloc[0]["P1 fixation"]
-            pminus1 = df[df["i"] == 1].iloc[0]["P2 fixation"]
-        except IndexError:
-            p1 = float("nan")
-            pminus1 = float("nan")
-
-
-        try:
-            if N % 2 == 0:
-                pnover2 = df[df["i"] == df["N"] / 2].iloc[0]["P1 fixation"]
-            else:
-                pnover2 = float("nan")
-        except IndexError:
-            pnover2 = float("nan")
-
-        dfs[0].append(pd.DataFrame([[player, opponent, N, Noise, p1, pnover2]],
-                                   columns=columns[0]))
-        dfs[1].append(pd.DataFrame([[opponent, player, N, Noise, pminus1]],
-                                   columns=columns[1]))
-
-    dfs = [pd.concat(dfs[0]), pd.concat(dfs[1])]
-
-    return dfs[0].merge(dfs[1], on=["player", "N","opponent", "Noise"])
-
-def read():
-    dfs = []
-    for N in range(2, 14 + 1):
-        dfs.append(merged_df(N))
-
-    return pd.concat(dfs)
-
-def write(df):
+
+
+def merged_df(summary):
+    """
+    Return the fixation probabilities of every player against every opponent
+    and N of the summary: $p_1$ and $p_{N-1}$ from the runs starting with 1
+    mutant, $p_{N/2}$ from the runs starting with N / 2 mutants.
+    """
+    keys = ["P1", "P2", "N", "Noise"]
+    groups = summary[keys].drop_duplicates()
+    ones = summary[summary["i"] == 1].drop_duplicates(keys)
+    halves = summary[(summary["N"] % 2 == 0) &
+                     (summary["i"] == summary["N"] / 2)].drop_duplicates(keys)
+
+    left = groups.merge(
+        ones[keys + ["P1 fixation"]].rename(
+            columns={"P1 fixation": "$p_1$"}), on=keys, how="left").merge(
+        halves[keys + ["P1 fixation"]].rename(
+            columns={"P1 fixation": "$p_{N/2}$"}), on=keys, how="left")
+    left = left.rename(columns={"P1": "player", "P2": "opponent"})
+
+    # The fixation of P2 starting with N - 1 of its kind
+    right = groups.merge(
+        ones[keys + ["P2 fixation"]].rename(
+            columns={"P2 fixation": "$p_{N-1}$"}), on=keys, how="left")
+    right = right.rename(columns={"P1": "opponent", "P2": "player"})
+
+    df = left.merge(right, on=["player", "N", "opponent", "Noise"])
+    df = df.sort_values(["N", "player", "opponent", "Noise"])
+    return df[["player", "opponent", "N", "Noise", "$p_1$", "$p_{N/2}$",
+               "$p_{N-1}$"]].reset_index(drop=True)
+
+
+def read(directory="../data"):
+    summary = pd.read_csv(Path(directory) / "sims_summary.csv")
+    return merged_df(summary[summary["N"].between(2, 14)])
+
+
+def write(df, directory="../data"):
     df = df[~df["Noise"]].drop("Noise", axis=1)
-    df.to_csv("../data/main.csv", index=False)
+    df.to_csv(Path(directory) / "main.csv", index=False)
+
 
 if __name__ == "__main__":
     fitness_df = read()
@@ -0,0 +1,310 @@
+"""
+A persistent index of the progress of a run.
+
+The index is a sqlite database kept next to the output file of a run. It holds
+the seed ranges completed for every task, and the size of the output file when
+they were recorded, so that an interrupted run can be resumed without redoing
+or duplicating any work. It also holds the time taken by tasks, used to
+schedule later runs (see `schedule.py`).
+"""
+import json
+from pathlib import Path
+import os
+import sqlite3
+
+# For tests
+import tempfile
+import unittest
+
+
+def progress_filename(filename):
+    """Return the filename of the progress index of an output file."""
+    return str(Path(filename).with_suffix(".progress.sqlite"))
+
+
+# The number of bytes at the start of an output file recorded to recognise it
+HEAD_SIZE = 256
+
+
+def read_head(filename, size=HEAD_SIZE):
+    """Return the first size bytes of a file."""
+    with open(filename, "rb") as f:
+        return f.read(size)
+
+
+class ProgressIndex(object):
+    """
+    The completed seed ranges [start, stop) of tasks, each task identified by
+    a tuple of integers.
+
+    If the output file is given, its path and first bytes are recorded with
+    its size, so that synchronise can tell whether a file is the one the
+    index describes.
+    """
+    def __init__(self, filename, output=None):
+        self.filename = filename
+        self.output = output
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS progress "
+                                    "(task TEXT, start INTEGER, stop INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS output "
+                                    "(size INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS timings "
+                                    "(task TEXT, repetitions INTEGER, "
+                                    "seconds REAL)")
+            columns = [row[1] for row in self.connection.execute(
+                "PRAGMA table_info(output)")]
+            # Indices written before the path and head were kept
+            if "path" not in columns:
+                self.connection.execute("ALTER TABLE output ADD COLUMN "
+                                        "path TEXT")
+                self.connection.execute("ALTER TABLE output ADD COLUMN "
+                                        "head BLOB")
+
+    def record(self, items, size, timings=()):
+        """
+        Record completed (task, start, stop) items, and the size of the output
+        file once their results are written, in a single transaction.
+
+        timings are the (task, repetitions, seconds) taken by the items.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO progress VALUES (?, ?, ?)",
+                [(json.dumps([int(t) for t in task]), int(start), int(stop))
+                 for task, start, stop in items])
+            self.connection.executemany(
+                "INSERT INTO timings VALUES (?, ?, ?)",
+                [(json.dumps([int(t) for t in task]), int(repetitions),
+                  float(seconds))
+                 for task, repetitions, seconds in timings])
+            path, head = None, None
+            if self.output is not None:
+                path = os.path.abspath(self.output)
+                head = read_head(self.output, min(size, HEAD_SIZE))
+            self.connection.execute("DELETE FROM output")
+            self.connection.execute("INSERT INTO output VALUES (?, ?, ?)",
+                                    (int(size), path, head))
+
+    def size(self):
+        """Return the size of the output file at the last record, if any."""
+        row = self.connection.execute("SELECT size FROM output").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM progress")
+            self.connection.execute("DELETE FROM output")
+
+    def synchronise(self, filename):
+        """
+        Make the output file and the index agree: results written after the
+        last record are removed from the output file, and the index is cleared
+        if the output file is missing.
+
+        Raises a ValueError, leaving both untouched, if the output file is
+        shorter than recorded or is not the file the index was recorded for.
+        """
+        row = self.connection.execute(
+            "SELECT size, path, head FROM output").fetchone()
+        if row is None or not os.path.exists(filename):
+            self.clear()
+            return
+        size, path, head = row
+        actual = os.path.getsize(filename)
+        problem = None
+        if path is not None and path != os.path.abspath(filename):
+            problem = "was recorded for {}".format(path)
+        elif actual < size:
+            problem = "records {} bytes but the file has {}".format(size,
+                                                                    actual)
+        elif head is not None and read_head(filename, len(head)) != head:
+            problem = "records a different start of file"
+        if problem is not None:
+            raise ValueError(
+                "The progress index {} of {} {}: check the output file and "
+                "remove the index to start it afresh".format(
+                    self.filename, filename, problem))
+        if actual > size:
+            with open(filename, "rb+") as f:
+                f.truncate(size)
+
+    def ranges(self):
+        """Return a dictionary mapping tasks to their completed seed ranges."""
+        ranges = {}
+        for task, start, stop in self.connection.execute(
+                "SELECT task, start, stop FROM progress"):
+            ranges.setdefault(tuple(json.loads(task)), []).append((start,
+                                                                    stop))
+        return ranges
+
+    def timings(self):
+        """
+        Return a dictionary mapping tasks to their mean seconds per
+        repetition. Timings are kept when the index is cleared.
+        """
+        return {tuple(json.loads(task)): seconds / repetitions
+                for task, repetitions, seconds in self.connection.execute(
+                    "SELECT task, SUM(repetitions), SUM(seconds) "
+                    "FROM timings GROUP BY task")
+                if repetitions > 0}
+
+    def close(self):
+        self.connection.close()
+
+
+def remaining(ranges, repetitions):
+    """
+    Return the seed ranges [start, stop) of range(repetitions) that are not
+    covered by the given completed ranges.
+    """
+    gaps = []
+    start = 0
+    for done_start, done_stop in sorted(ranges):
+        if done_start > start:
+            gaps.append((start, min(done_start, repetitions)))
+        start = max(start, done_stop)
+        if start >= repetitions:
+            break
+    if start < repetitions:
+        gaps.append((start, repetitions))
+    return [(a, b) for a, b in gaps if a < b]
+
+
+def remaining_members(member_ranges, repetitions):
+    """
+    Return the (start, stop, missing) seed ranges of range(repetitions) not
+    covered by the completed ranges of every member of a group, missing being
+    the indices of the members that have not completed [start, stop).
+    """
+    gaps = [remaining(ranges, repetitions) for ranges in member_ranges]
+    bounds = sorted({bound for member in gaps for gap in member
+                     for bound in gap})
+    segments = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        missing = tuple(k for k, member in enumerate(gaps)
+                        if any(a <= start and stop <= b for a, b in member))
+        if not missing:
+            continue
+        if segments and segments[-1][1] == start and \
+                segments[-1][2] == missing:
+            start = segments.pop()[0]
+        segments.append((start, stop, missing))
+    return segments
+
+
+#########
+# Tests #
+#########
+
+
+class TestRemaining(unittest.TestCase):
+    def test_remaining(self):
+        self.assertEqual(remaining([], 10), [(0, 10)])
+        self.assertEqual(remaining([(0, 10)], 10), [])
+        self.assertEqual(remaining([(0, 4)], 10), [(4, 10)])
+        self.assertEqual(remaining([(6, 8), (0, 4)], 10), [(4, 6), (8, 10)])
+        self.assertEqual(remaining([(2, 4), (3, 12)], 10), [(0, 2)])
+        self.assertEqual(remaining([(12, 14)], 10), [(0, 10)])
+
+    def test_remaining_members(self):
+        self.assertEqual(remaining_members([[], []], 10), [(0, 10, (0, 1))])
+        self.assertEqual(remaining_members([[(0, 5)], [(0, 2)]], 10),
+                         [(2, 5, (1,)), (5, 10, (0, 1))])
+        self.assertEqual(remaining_members([[(0, 5)], [(0, 8)]], 5), [])
+        self.assertEqual(remaining_members([[(0, 5)], [(0, 8)]], 10),
+                         [(5, 8, (0,)), (8, 10, (0, 1))])
+        self.assertEqual(remaining_members([[(0, 2), (4, 6)], [(0, 6)]], 6),
+                         [(2, 4, (0,))])
+
+
+class TestProgressIndex(unittest.TestCase):
+    def test_progress_filename(self):
+        self.assertEqual(progress_filename("../data/sims_4.csv"),
+                         "../data/sims_4.progress.sqlite")
+
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = str(Path(directory) / "progress.sqlite")
+            index = ProgressIndex(filename)
+            self.assertIsNone(index.size())
+            self.assertEqual(index.ranges(), {})
+            index.record([((0, 1, 4, 1), 0, 10), ((1, 0, 4, 1), 0, 5)], 40)
+            index.record([((1, 0, 4, 1), 5, 10)], 60)
+            index.close()
+
+            index = ProgressIndex(filename)
+            self.assertEqual(index.size(), 60)
+            self.assertEqual(index.ranges(),
+                             {(0, 1, 4, 1): [(0, 10)],
+                              (1, 0, 4, 1): [(0, 5), (5, 10)]})
+
+    def test_timings(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index = ProgressIndex(str(Path(directory) / "progress.sqlite"))
+            self.assertEqual(index.timings(), {})
+            index.record([((0, 1), 0, 10)], 40, [((0, 1), 10, 2.0)])
+            index.record([((0, 1), 10, 40)], 60, [((0, 1), 30, 4.0),
+                                                   ((1, 0), 0, 1.0)])
+            index.clear()
+            self.assertEqual(index.timings(), {(0, 1): 0.15})
+
+    def test_synchronise(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = str(Path(directory) / "output.csv")
+            index = ProgressIndex(progress_filename(output))
+            with open(output, "w") as f:
+                f.write("0,1,0,5\n0,1,1,5\n1,0,1,")
+            index.record([((0, 1), 0, 10)], 16)
+            index.synchronise(output)
+            with open(output, "r") as f:
+                self.assertEqual(f.read(), "0,1,0,5\n0,1,1,5\n")
+            self.assertEqual(index.ranges(), {(0, 1): [(0, 10)]})
+
+            os.remove(output)
+            index.synchronise(output)
+            self.assertIsNone(index.size())
+            self.assertEqual(index.ranges(), {})
+
+    def test_synchronise_mismatch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = str(Path(directory) / "output.csv")
+            index = ProgressIndex(progress_filename(output), output)
+            with open(output, "w") as f:
+                f.write("0,1,0,5\n0,1,1,5\n")
+            index.record([((0, 1), 0, 10)], 16)
+            index.synchronise(output)
+
+            # A different file: left untouched
+            with open(output, "w") as f:
+                f.write("1,0,0,5\n1,0,1,5\n1,0,1,3\n")
+            with self.assertRaises(ValueError):
+                index.synchronise(output)
+            # A shorter file
+            with open(output, "w") as f:
+                f.write("0,1,0,5\n")
+            with self.assertRaises(ValueError):
+                index.synchronise(output)
+            with open(output, "r") as f:
+                self.assertEqual(f.read(), "0,1,0,5\n")
+            self.assertEqual(index.ranges(), {(0, 1): [(0, 10)]})
+
+            # The index of another file
+            other = str(Path(directory) / "other.csv")
+            with open(other, "w") as f:
+                f.write("0,1,0,5\n0,1,1,5\n")
+            with self.assertRaises(ValueError):
+                index.synchronise(other)
+
+    def test_legacy_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = progress_filename(str(Path(directory) / "output.csv"))
+            connection = sqlite3.connect(filename)
+            with connection:
+                connection.execute("CREATE TABLE output (size INTEGER)")
+                connection.execute("INSERT INTO output VALUES (16)")
+            connection.close()
+            self.assertEqual(ProgressIndex(filename).size(), 16)
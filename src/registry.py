@@ -0,0 +1,116 @@
+"""
+A registry of strategies, giving every player a compact integer id.
+
+Players are identified by `players.strategy_id`, a hash of their strategy and
+parameters. The registry is kept in `../data/players.csv`, one row (id, name,
+stochastic, hash) per player. A player keeps its id when players are added to,
+or reordered in, `players.selected_players`, so files written with ids stay
+valid. Rows written before the hash was kept are matched by name.
+"""
+import csv
+from pathlib import Path
+
+from players import strategy_id
+
+# For tests
+import tempfile
+import unittest
+
+import axelrod as axl
+
+
+class Registry(object):
+    """The (id, name, stochastic, hash) rows of registered players."""
+    def __init__(self, rows=()):
+        self.rows = []
+        self.ids = {}
+        self.name_ids = {}
+        for row in rows:
+            self.add(*row)
+
+    def add(self, id, name, stochastic, hash=None):
+        self.rows.append([int(id), name, stochastic, hash])
+        if hash is not None:
+            self.ids[hash] = int(id)
+        else:
+            self.name_ids[name] = int(id)
+
+    def register(self, players):
+        """Return the ids of players, registering the new ones."""
+        ids = []
+        for player in players:
+            hash = strategy_id(player)
+            name = str(player)
+            if hash not in self.ids and name in self.name_ids:
+                # A row without a hash: record it
+                id = self.name_ids.pop(name)
+                row = next(row for row in self.rows if row[0] == id)
+                row[3] = hash
+                self.ids[hash] = id
+            elif hash not in self.ids:
+                self.add(len(self.rows), name,
+                         player.classifier["stochastic"], hash)
+            ids.append(self.ids[hash])
+        return ids
+
+    def names(self):
+        """Return a dictionary mapping ids to player names."""
+        return {row[0]: row[1] for row in self.rows}
+
+    def write(self, filename):
+        with Path(filename).open("w") as f:
+            writer = csv.writer(f)
+            writer.writerows([row if row[3] is not None else row[:3]
+                              for row in self.rows])
+
+
+def read_registry(filename):
+    """Return the registry kept in filename, empty if there is none."""
+    try:
+        with Path(filename).open("r") as f:
+            return Registry(tuple(row) for row in csv.reader(f))
+    except FileNotFoundError:
+        return Registry()
+
+
+#########
+# Tests #
+#########
+
+
+class TestRegistry(unittest.TestCase):
+    def test_register(self):
+        registry = Registry()
+        players = [axl.Cooperator(), axl.Random(), axl.Random(0.2)]
+        self.assertEqual(registry.register(players), [0, 1, 2])
+        self.assertEqual(registry.register([axl.Random(0.2), axl.Defector(),
+                                            axl.Cooperator()]), [2, 3, 0])
+        self.assertEqual(registry.names(),
+                         {0: "Cooperator", 1: "Random: 0.5", 2: "Random: 0.2",
+                          3: "Defector"})
+
+    def test_read_and_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/players.csv"
+            self.assertEqual(read_registry(filename).rows, [])
+            registry = Registry()
+            registry.register([axl.Cooperator(), axl.Defector()])
+            registry.write(filename)
+            registry = read_registry(filename)
+            self.assertEqual(registry.register([axl.Defector(),
+                                                axl.TitForTat()]), [1, 2])
+
+    def test_rows_without_hash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/players.csv"
+            with open(filename, "w") as f:
+                f.write("0,Cooperator,False\n1,Defector,False\n")
+            registry = read_registry(filename)
+            self.assertEqual(registry.register([axl.TitForTat(),
+                                                axl.Defector()]), [2, 1])
+            registry.write(filename)
+            with open(filename, "r") as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows[0], ["0", "Cooperator", "False"])
+            self.assertEqual(rows[1][:3], ["1", "Defector", "False"])
+            self.assertEqual(len(rows[1][3]), 15)
@@ -0,0 +1,232 @@
+"""
+Writing the results of parallel runs to file.
+
+Workers return the rows they produce to the parent process, which is the only
+process writing to the output file. Rows are written in batches of whole rows.
+"""
+import csv
+import functools
+import io
+import multiprocessing
+import os
+import time
+
+import progress as progress_index
+import work_queue
+
+# For tests
+import tempfile
+import unittest
+
+
+def repair(filename):
+    """
+    Remove an incomplete last row from a file, left by a run that was
+    interrupted while writing.
+    """
+    try:
+        with open(filename, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            # Read backwards until the end of the last complete row
+            end = size
+            while end > 0:
+                start = max(0, end - 2 ** 16)
+                f.seek(start)
+                position = f.read(end - start).rfind(b"\n")
+                if position >= 0:
+                    f.truncate(start + position + 1)
+                    return
+                end = start
+            f.truncate(0)
+    except FileNotFoundError:
+        pass
+
+
+class ResultsSink(object):
+    """
+    Append rows to a csv file, flushing them to disk every `flush_every` rows.
+
+    If a progress index is given, the work that produced the rows, and the
+    time it took, are recorded in it once they are on disk.
+    """
+    def __init__(self, filename, flush_every=1000, progress=None):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.progress = progress
+        self.rows = []
+        self.done = []
+        self.timings = []
+        repair(filename)
+        self.file = open(filename, "a")
+
+    def write(self, rows, done=(), seconds=None):
+        """Write rows, and the (task, start, stop) items of progress they
+        complete. The seconds taken are recorded against the first item."""
+        self.rows.extend(rows)
+        self.done.extend(done)
+        if seconds is not None and done:
+            task, start, stop = done[0]
+            self.timings.append((task, stop - start, seconds))
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.rows or self.done:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(self.rows)
+            self.file.write(buffer.getvalue())
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if self.progress is not None:
+                self.progress.record(self.done, self.file.tell(),
+                                     self.timings)
+            self.rows = []
+            self.done = []
+            self.timings = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_task(func, args):
+    """Return the arguments, the result of func(*args) and the seconds it
+    took"""
+    start = time.perf_counter()
+    result = func(*args)
+    return args, result, time.perf_counter() - start
+
+
+def write_results(func, tasks, filename, processes=None, flush_every=1000,
+                  chunksize=1, progress=None, record=None, queue=None):
+    """
+    Call func(*task) for every task and write the rows it returns to filename.
+
+    If processes is not None, the tasks are run by a pool of that many
+    processes (all available cpus if 0) and the rows are sent back to this
+    process to be written. If a queue directory is given instead, the tasks
+    are run by the workers of that queue, possibly on other machines (see
+    `work_queue.py`).
+
+    If a progress index is given, record(task) is the list of (task, start,
+    stop) items of progress recorded once the rows of a task are written.
+
+    Tasks are dispatched in the order given (see `schedule.py`).
+    """
+    with ResultsSink(filename, flush_every=flush_every,
+                     progress=progress) as sink:
+        if queue is not None:
+            results = work_queue.collect(func, tasks, queue)
+        elif processes is None:
+            results = (run_task(func, task) for task in tasks)
+        else:
+            if processes == 0:
+                processes = multiprocessing.cpu_count()
+            p = multiprocessing.Pool(processes)
+            results = p.imap_unordered(functools.partial(run_task, func),
+                                       tasks, chunksize=chunksize)
+        for task, rows, seconds in results:
+            sink.write(rows, record(task) if progress is not None else (),
+                       seconds)
+        if queue is None and processes is not None:
+            p.close()
+            p.join()
+
+
+#########
+# Tests #
+#########
+
+
+def rows_of(i, n):
+    """Return n rows for task i"""
+    return [[i, k, "Player, {}".format(i)] for k in range(n)]
+
+
+class TestRepair(unittest.TestCase):
+    def test_repair(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        for content, expected in [(b"", b""),
+                                  (b"0,1,0,5\n", b"0,1,0,5\n"),
+                                  (b"0,1,0,5\n0,1,", b"0,1,0,5\n"),
+                                  (b"0,1,0", b"")]:
+            with open(temp_file.name, "wb") as f:
+                f.write(content)
+            repair(temp_file.name)
+            with open(temp_file.name, "rb") as f:
+                self.assertEqual(f.read(), expected)
+        temp_file.close()
+
+    def test_missing_file(self):
+        repair("this file does not exist.csv")
+
+
+class TestWriteResults(unittest.TestCase):
+    tasks = [(i, i % 3 + 1) for i in range(10)]
+
+    def expected(self):
+        return sorted(tuple(map(str, row)) for task in self.tasks
+                      for row in rows_of(*task))
+
+    def read(self, filename):
+        with open(filename, "r") as f:
+            return sorted(tuple(row) for row in csv.reader(f))
+
+    def test_serial(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        write_results(rows_of, self.tasks, temp_file.name, flush_every=3)
+        self.assertEqual(self.read(temp_file.name), self.expected())
+        temp_file.close()
+
+    def test_parallel(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        write_results(rows_of, self.tasks, temp_file.name, processes=2)
+        self.assertEqual(self.read(temp_file.name), self.expected())
+        temp_file.close()
+
+    def test_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/output.csv"
+            queue = directory + "/queue"
+            work_queue.clear(queue)
+            worker = multiprocessing.Process(
+                target=work_queue.work, args=(queue, {"rows_of": rows_of}),
+                kwargs={"poll": 0.01})
+            worker.start()
+            write_results(rows_of, self.tasks, filename, queue=queue)
+            worker.join()
+            self.assertEqual(self.read(filename), self.expected())
+
+    def test_appends_after_incomplete_row(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        with open(temp_file.name, "w") as f:
+            f.write("0,0,\"Player, 0\"\n3,0,\"Pla")
+        write_results(rows_of, self.tasks[1:], temp_file.name)
+        self.assertEqual(self.read(temp_file.name), self.expected())
+        temp_file.close()
+
+    def test_progress(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = directory + "/output.csv"
+            index = progress_index.ProgressIndex(
+                progress_index.progress_filename(filename))
+            write_results(rows_of, self.tasks[:4], filename, processes=2,
+                          flush_every=2, progress=index,
+                          record=lambda task: [((task[0],), 0, task[1])])
+            self.assertEqual(index.ranges(),
+                             {(i,): [(0, n)] for i, n in self.tasks[:4]})
+            self.assertEqual(index.size(), os.path.getsize(filename))
+            self.assertEqual(set(index.timings()),
+                             {(i,) for i, _ in self.tasks[:4]})
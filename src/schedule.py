@@ -0,0 +1,166 @@
+"""
+Scheduling tasks of uneven cost on a pool of processes.
+
+The cost of a task is the time the same task took in past runs, as recorded in
+the progress index, or else an estimate from the classifiers of the strategies
+involved. The most expensive tasks are dispatched first and the seed ranges of
+tasks costing more than a fair share of the run are split, so that the end of a
+run is not left to a few long tasks while the other processes are idle.
+"""
+import math
+import multiprocessing
+
+import axelrod as axl
+import numpy as np
+
+# For tests
+import unittest
+
+
+def player_cost(player):
+    """Return the relative cost of playing a match with a player."""
+    cost = 1
+    if player.classifier["memory_depth"] == float("inf"):
+        cost *= 4
+    if player.classifier.get("long_run_time", False):
+        cost *= 100
+    return cost
+
+
+def is_stochastic(player1, player2, noise=0):
+    return (noise > 0 or player1.classifier["stochastic"] or
+            player2.classifier["stochastic"])
+
+
+def match_cost(player1, player2, repetitions, noise=0):
+    """
+    Return the relative cost of sampling the outcomes of the matches between
+    two players: a single match is played if neither is stochastic.
+    """
+    cost = player_cost(player1) + player_cost(player2)
+    if is_stochastic(player1, player2, noise):
+        cost *= repetitions
+    return cost
+
+
+def moran_cost(player1, player2, N):
+    """
+    Return the relative cost of a Moran process between two types of players.
+
+    Pairs of deterministic players have a single match outcome and their wins
+    are sampled from the exact fixation probability.
+    """
+    if is_stochastic(player1, player2):
+        return N ** 2
+    return 0.01
+
+
+def costs(tasks, estimate, timings):
+    """
+    Return the costs, in seconds, of (key, start, stop) tasks.
+
+    timings maps keys to their past seconds per repetition. Tasks without a
+    past timing are costed by estimate(key), per repetition, scaled to seconds
+    by the tasks that have one.
+    """
+    keys = {key for key, _, _ in tasks}
+    ratios = [timings[key] / estimate(key) for key in keys
+              if key in timings and estimate(key) > 0]
+    scale = float(np.median(ratios)) if ratios else 1
+    return [(stop - start) * timings.get(key, scale * estimate(key))
+            for key, start, stop in tasks]
+
+
+def split_range(start, stop, pieces, align=1):
+    """
+    Split a seed range [start, stop) in to at most `pieces` ranges, whose
+    bounds, other than start and stop, are multiples of align.
+    """
+    bounds = np.linspace(start, stop, pieces + 1)
+    bounds[1:-1] = (bounds[1:-1] / align).round() * align
+    bounds = bounds.round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def schedule(tasks, task_costs, processes=0, pieces=4, min_size=10,
+             split=True, align=1):
+    """
+    Return (key, start, stop) tasks in the order they should be dispatched:
+    the most expensive first.
+
+    If split is True, the seed range of a task costing more than
+    1 / (processes * pieces) of the total is split in to ranges of at least
+    min_size repetitions, split at multiples of align.
+    """
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    share = sum(task_costs) / (processes * pieces)
+    scheduled = []
+    for (key, start, stop), cost in zip(tasks, task_costs):
+        count = 1
+        if split and share > 0:
+            count = min(math.ceil(cost / share), (stop - start) // min_size)
+        ranges = split_range(start, stop, max(count, 1), align)
+        scheduled.extend((cost * (b - a) / (stop - start), (key, a, b))
+                         for a, b in ranges)
+    scheduled.sort(key=lambda item: item[0], reverse=True)
+    return [task for _, task in scheduled]
+
+
+#########
+# Tests #
+#########
+
+
+class TestCosts(unittest.TestCase):
+    def test_match_cost(self):
+        self.assertEqual(match_cost(axl.Cooperator(), axl.Defector(), 100), 2)
+        self.assertEqual(match_cost(axl.Cooperator(), axl.Defector(), 100,
+                                    noise=0.1), 200)
+        self.assertEqual(match_cost(axl.Random(), axl.ArrogantQLearner(),
+                                    100), 500)
+
+    def test_moran_cost(self):
+        self.assertEqual(moran_cost(axl.Cooperator(), axl.Defector(), 4),
+                         0.01)
+        self.assertEqual(moran_cost(axl.Random(), axl.Defector(), 4), 16)
+
+    def test_costs(self):
+        tasks = [("a", 0, 10), ("b", 0, 20), ("c", 5, 10)]
+        estimate = {"a": 1, "b": 2, "c": 4}.get
+        self.assertEqual(costs(tasks, estimate, {}), [10, 40, 20])
+        # Estimates are scaled to the past timings
+        self.assertEqual(costs(tasks, estimate, {"a": 0.5}), [5, 20, 10])
+        self.assertEqual(costs(tasks, estimate, {"a": 0.5, "b": 3}),
+                         [5, 60, 20])
+
+
+class TestSchedule(unittest.TestCase):
+    def test_split_range(self):
+        self.assertEqual(split_range(0, 10, 1), [(0, 10)])
+        self.assertEqual(split_range(10, 20, 2), [(10, 15), (15, 20)])
+        self.assertEqual(split_range(0, 2, 4), [(0, 1), (1, 2)])
+        self.assertEqual(split_range(0, 1000, 3, align=100),
+                         [(0, 300), (300, 700), (700, 1000)])
+        self.assertEqual(split_range(50, 250, 4, align=100),
+                         [(50, 100), (100, 200), (200, 250)])
+
+    def test_longest_first(self):
+        tasks = [("a", 0, 10), ("b", 0, 10), ("c", 0, 10)]
+        self.assertEqual(schedule(tasks, [1, 3, 2], processes=1, split=False),
+                         [("b", 0, 10), ("c", 0, 10), ("a", 0, 10)])
+
+    def test_split(self):
+        tasks = [("a", 0, 100), ("b", 0, 100)]
+        scheduled = schedule(tasks, [90, 10], processes=2, pieces=1)
+        self.assertEqual(scheduled, [("a", 0, 50), ("a", 50, 100),
+                                     ("b", 0, 100)])
+        # Pieces have at least min_size repetitions
+        scheduled = schedule(tasks, [90, 10], processes=8, min_size=40)
+        self.assertEqual(scheduled, [("a", 0, 50), ("a", 50, 100),
+                                     ("b", 0, 50), ("b", 50, 100)])
+        # Pieces are split at multiples of align
+        scheduled = schedule([("a", 0, 1000)], [1], processes=3, pieces=1,
+                             min_size=100, align=100)
+        self.assertEqual(scheduled, [("a", 300, 700), ("a", 0, 300),
+                                     ("a", 700, 1000)])
@@ -0,0 +1,87 @@
+"""
+Independent random number streams for the replicates of a simulation.
+
+Every stream is derived from a root seed and a key, for example the ids of a
+pair of players, N and n, through a numpy SeedSequence: the stream of a
+replicate is the child of `SeedSequence(root)` with spawn key (*key,
+replicate), as given by `SeedSequence.spawn`. The numbers drawn for a
+replicate therefore only depend on the root seed, the key and the replicate,
+not on the other replicates run by the same process, the number of processes
+or the way seed ranges are split.
+
+Engines that run many replicates at once as arrays use one stream per block of
+BLOCK_SIZE consecutive replicates instead, and always run whole blocks.
+"""
+import numpy as np
+
+# For tests
+import unittest
+
+BLOCK_SIZE = 100
+
+# Keeps the replicate and block streams of a key apart
+REPLICATE, BLOCK = 0, 1
+
+
+def generator(root, key, kind, index):
+    """Return the generator of the stream (kind, *key, index)."""
+    sequence = np.random.SeedSequence(
+        root, spawn_key=(kind, *(int(k) for k in key), int(index)))
+    return np.random.Generator(np.random.PCG64(sequence))
+
+
+def replicate_rng(root, key, replicate):
+    """Return the generator of a single replicate."""
+    return generator(root, key, REPLICATE, replicate)
+
+
+def block_rng(root, key, block):
+    """
+    Return the generator of the block of replicates block * BLOCK_SIZE, ...,
+    (block + 1) * BLOCK_SIZE - 1.
+    """
+    return generator(root, key, BLOCK, block)
+
+
+def blocks(start, stop):
+    """
+    Return the (block, lower, upper) of the blocks covering the replicates
+    start, ..., stop - 1: replicates lower, ..., upper - 1 of each block are in
+    the range.
+    """
+    return [(block, max(start - block * BLOCK_SIZE, 0),
+             min(stop - block * BLOCK_SIZE, BLOCK_SIZE))
+            for block in range(start // BLOCK_SIZE,
+                               -(-stop // BLOCK_SIZE))
+            if start < stop]
+
+
+#########
+# Tests #
+#########
+
+
+class TestStreams(unittest.TestCase):
+    def test_replicate_rng(self):
+        first = replicate_rng(0, (1, 2, 4, 1), 5).random(3)
+        np.testing.assert_array_equal(
+            first, replicate_rng(0, (1, 2, 4, 1), 5).random(3))
+        for other in [replicate_rng(1, (1, 2, 4, 1), 5),
+                      replicate_rng(0, (2, 1, 4, 1), 5),
+                      replicate_rng(0, (1, 2, 4, 1), 6),
+                      block_rng(0, (1, 2, 4, 1), 5)]:
+            self.assertFalse(np.array_equal(first, other.random(3)))
+
+    def test_matches_spawn(self):
+        parent = np.random.SeedSequence(3, spawn_key=(REPLICATE, 1))
+        child = parent.spawn(3)[2]
+        np.testing.assert_array_equal(
+            np.random.Generator(np.random.PCG64(child)).random(3),
+            replicate_rng(3, (1,), 2).random(3))
+
+    def test_blocks(self):
+        self.assertEqual(blocks(0, 100), [(0, 0, 100)])
+        self.assertEqual(blocks(50, 250), [(0, 50, 100), (1, 0, 100),
+                                           (2, 0, 50)])
+        self.assertEqual(blocks(120, 130), [(1, 20, 30)])
+        self.assertEqual(blocks(10, 10), [])
@@ -2,3 +2,29 @@ echo "Testing moran.py"
 python -m unittest moran.py
 echo "Testing theoretic.py"
 python -m unittest theoretic.py
+echo "Testing outcome_store.py"
+python -m unittest outcome_store.py
+echo "Testing results.py"
+python -m unittest results.py
+echo "Testing progress.py"
+python -m unittest progress.py
+echo "Testing schedule.py"
+python -m unittest schedule.py
+echo "Testing work_queue.py"
+python -m unittest work_queue.py
+echo "Testing generate_cache.py"
+python -m unittest generate_cache.py
+echo "Testing registry.py"
+python -m unittest registry.py
+echo "Testing abbreviations.py"
+python -m unittest abbreviations.py
+echo "Testing match_engine.py"
+python -m unittest match_engine.py
+echo "Testing streams.py"
+python -m unittest streams.py
+echo "Testing benchmark.py"
+python -m unittest benchmark.py
+echo "Testing clean_raw_moran.py"
+python -m unittest clean_raw_moran.py
+echo "Testing generate_cooperation_data.py"
+python -m unittest generate_cooperation_data.py
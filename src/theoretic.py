@@ -4,7 +4,8 @@ Code to calculate analytic fixation probabilities
 import unittest
 import numpy as np
 import math
-import functools
+import itertools
+import fractions
 
 from scipy.optimize import newton
 
@@ -83,19 +84,288 @@ def transition(strategy_pair, N, i, utilities, fitness_type="nowak",
     p_stay = 1 - p_up - p_down
     return p_down, p_stay, p_up
 
+def log_fitness_ratios(a, b, c, d, N, i, fitness_type="nowak",
+                       selection_intensity=1):
+    """
+    Return log(p_down / p_up) = log(G / F) in the states i, for the scores
+    matrix [[a, b], [c, d]], broadcasting over the arrays given.
+
+    The ratio is nan where a fitness is negative.
+    """
+    f = (a * (i - 1) + b * (N - i)) / (N - 1)
+    g = (c * i + d * (N - i - 1)) / (N - 1)
+    if fitness_type == "nowak":
+        F = 1 + selection_intensity * (f - 1)
+        G = 1 + selection_intensity * (g - 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.log(G) - np.log(F)
+    # The fermi fitness ratio G / F is exp(g - f)
+    return g - f
+
+def log_fixation(log_ratios):
+    """
+    Return the fixation probabilities from i = 1, ..., N - 1 given the log
+    ratios log(p_down / p_up) of the states j = 1, ..., N - 1 along the last
+    axis.
+
+    With t_j the product of the first j ratios, the fixation probability
+    from i is (1 + t_1 + ... + t_{i - 1}) / (1 + t_1 + ... + t_{N - 1}):
+    the partial sums are accumulated as logarithms so that they neither
+    overflow nor underflow.
+    """
+    log_t = np.cumsum(log_ratios, axis=-1)
+    zeros = np.zeros(log_t.shape[:-1] + (1,))
+    with np.errstate(invalid="ignore"):
+        log_sums = np.logaddexp.accumulate(
+            np.concatenate([zeros, log_t], axis=-1), axis=-1)
+        return np.exp(log_sums[..., :-1] - log_sums[..., -1:])
+
+def linear_fixation(ratios):
+    """
+    Return the fixation probabilities from i = 1, ..., N - 1 given the ratios
+    p_down / p_up along the last axis, computed in linear space.
+    """
+    s = np.cumsum(np.cumprod(ratios, axis=-1), axis=-1)
+    with np.errstate(invalid="ignore"):
+        return np.concatenate([1 / (1 + s[..., -1:]),
+                               (1 + s[..., :-1]) / (1 + s[..., -1:])],
+                              axis=-1)
+
+def constant_fitness_fixation(log_ratio, N):
+    """
+    Return the fixation probabilities from i = 1, ..., N - 1 when the fitness
+    ratio does not depend on i: with x = log(G / F), the fixation
+    probability from i is (1 - exp(i x)) / (1 - exp(N x)), i / N if x = 0.
+    """
+    i = np.arange(1, N)
+    if log_ratio == 0:
+        return i / N
+    if log_ratio > 0:
+        # exp(i x) would overflow: divide by exp(N x)
+        return (np.exp((i - N) * log_ratio) * np.expm1(-i * log_ratio) /
+                np.expm1(-N * log_ratio))
+    return np.expm1(i * log_ratio) / np.expm1(N * log_ratio)
+
+def fixation_probabilities(strategy_pair, N, utilities,
+                           fitness_type="nowak", selection_intensity=1):
+    """
+    Return the fixation probabilities of the first strategy of a pair for
+    every starting number of individuals of the first type i = 1, ..., N - 1.
+
+    The chain is solved in log space, vectorised over i, and in closed form
+    when the fitness of both types does not depend on i.
+    """
+    (a, b), (c, d) = scores(strategy_pair, utilities)
+    i = np.arange(1, N)
+    log_ratios = log_fitness_ratios(a, b, c, d, N, i, fitness_type,
+                                    selection_intensity)
+    if np.isnan(log_ratios).any():
+        # A negative fitness: the ratios can only be taken in linear space
+        ratios = [p_down / p_up
+                  for p_down, _, p_up in (
+                      transition(strategy_pair, N, j, utilities,
+                                 fitness_type, selection_intensity)
+                      for j in range(1, N))]
+        return linear_fixation(np.array(ratios))
+    if a == b and c == d and np.isfinite(log_ratios[0]):
+        return constant_fitness_fixation(log_ratios[0], N)
+    return log_fixation(log_ratios)
+
 def fixation(strategy_pair, N, i, utilities,
              fitness_type="nowak", selection_intensity=1):
     """Return the fixation probability for each pair"""
-    ratios = []
-    for j in range(1, N): # ignore first and last transitions, which are likely zero
-        p_down, _, p_up = transition(strategy_pair, N, i=j, utilities=utilities,
-                                     fitness_type=fitness_type, selection_intensity=selection_intensity)
-        ratios.append(p_down / p_up)
-    t = np.cumprod(ratios)
-    s = np.cumsum(t)
-    if i > 1:
-        return (1 + s[i - 2]) / (1 + s[-1])
-    return 1 / (1 + s[-1])
+    return fixation_probabilities(strategy_pair, N, utilities, fitness_type,
+                                  selection_intensity)[i - 1]
+
+def utilities_matrix(utilities, strategies):
+    """
+    Return the dense matrix of utilities: the entry [k, l] is the mean score of
+    strategies[k] against strategies[l].
+    """
+    index = {strategy: k for k, strategy in enumerate(strategies)}
+    A = np.full((len(strategies), len(strategies)), np.nan)
+    for (s1, s2), (u1, u2) in utilities.items():
+        if s1 in index and s2 in index:
+            A[index[s2], index[s1]] = u2
+            A[index[s1], index[s2]] = u1
+    return A
+
+def fixation_array(A, Ns, fitness_type="nowak", selection_intensity=1):
+    """
+    Return the fixation probabilities for every ordered pair of strategies,
+    every population size in Ns and every starting number of individuals of
+    the first type, given a dense matrix of utilities A.
+
+    The entry [k, s1, s2, i - 1] is fixation((s1, s2), Ns[k], i), entries
+    with i >= Ns[k] are nan.
+    """
+    A = np.asarray(A, dtype=float)
+    diagonal = A.diagonal()
+    # The scores matrix of every ordered pair, with a trailing axis for i
+    a = diagonal[:, None, None]
+    b = A[:, :, None]
+    c = A.T[:, :, None]
+    d = diagonal[None, :, None]
+
+    fixations = np.full((len(Ns), len(A), len(A), max(Ns) - 1), np.nan)
+    for k, N in enumerate(Ns):
+        i = np.arange(1, N)
+        log_ratios = log_fitness_ratios(a, b, c, d, N, i, fitness_type,
+                                        selection_intensity)
+        fixations[k, :, :, :N - 1] = log_fixation(log_ratios)
+        negative = np.isnan(log_ratios).any(axis=-1) & ~np.isnan(A)
+        if negative.any():
+            # A negative fitness: the ratios can only be taken in linear space
+            f = (a * (i - 1) + b * (N - i)) / (N - 1)
+            g = (c * i + d * (N - i - 1)) / (N - 1)
+            F = 1 + selection_intensity * (f - 1)
+            G = 1 + selection_intensity * (g - 1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                linear = linear_fixation(G / F)
+            fixations[k, :, :, :N - 1][negative] = linear[negative]
+    return fixations
+
+def lattice_scale(pdfs, max_denominator=10 ** 4):
+    """
+    Return the smallest integer scale such that the scores of every outcome of
+    the pdfs, times the scale, are integers: scores per turn of matches of
+    200 turns give 200.
+
+    Raises a ValueError if there is no such scale up to max_denominator, or if
+    a score is negative.
+    """
+    scale = 1
+    for pdf in pdfs:
+        for value in itertools.chain(*pdf.sample_space):
+            denominator = fractions.Fraction(value).limit_denominator(
+                max_denominator).denominator
+            scale = scale * denominator // math.gcd(scale, denominator)
+    if scale > max_denominator:
+        raise ValueError("The scores are not on a lattice")
+    for pdf in pdfs:
+        values = np.array(pdf.sample_space, dtype=float) * scale
+        if (values < 0).any():
+            raise ValueError("The scores are negative")
+        if not np.allclose(values, np.round(values), rtol=0, atol=1e-6):
+            raise ValueError("The scores are not on a lattice")
+    return scale
+
+def convolve(first, second, max_work=10 ** 6):
+    """
+    Return the distribution of the sum of two independent random vectors of
+    non negative integers, given as (values, probabilities) arrays with one
+    row of values per point of the support.
+
+    Raises a ValueError if this takes more than max_work pairs of points.
+    """
+    x, p = first
+    y, q = second
+    if len(x) * len(y) > max_work:
+        raise ValueError("The distribution is too expensive to compute")
+    # Encode every pair of coordinates (u, v) as u * width + v
+    width = int(x[:, 1].max() + y[:, 1].max()) + 1
+    if (x[:, 0].max() + y[:, 0].max() + 1) * width >= 2 ** 62:
+        raise ValueError("The values of the distribution are too large")
+    keys = ((x[:, None, 0] + y[None, :, 0]) * width +
+            x[:, None, 1] + y[None, :, 1]).ravel()
+    keys, inverse = np.unique(keys, return_inverse=True)
+    probabilities = np.bincount(inverse.ravel(), weights=np.outer(p, q).ravel(),
+                                minlength=len(keys))
+    return np.column_stack([keys // width, keys % width]), probabilities
+
+def sum_distribution(distribution, size, max_work=10 ** 6):
+    """
+    Return the distribution of the sum of `size` independent samples of a
+    distribution, given as (values, probabilities) arrays.
+    """
+    total = (np.zeros((1, 2), dtype=np.int64), np.ones(1))
+    while size > 0:
+        if size % 2 == 1:
+            total = convolve(total, distribution, max_work)
+        size //= 2
+        if size > 0:
+            distribution = convolve(distribution, distribution, max_work)
+    return total
+
+def fitness_distribution(pdf, contribution, scale=1):
+    """
+    Return the (values, probabilities) arrays of the distribution of the
+    contribution of a match to the fitness of both types, in units of
+    1 / scale, given an axelrod.Pdf of the match outcomes and a function
+    mapping the scores of the match to that contribution.
+    """
+    scores = np.round(np.array(pdf.sample_space, dtype=float) *
+                      scale).astype(np.int64)
+    values = np.array([contribution(a, b) for a, b in scores],
+                      dtype=np.int64)
+    return values, np.array(pdf.probability, dtype=float)
+
+def outcome_birth_probability(strategy_pair, N, i, outcomes, max_work=10 ** 6,
+                              scale=None):
+    """
+    Return the probability that a player of the first type is chosen to
+    reproduce in an approximate Moran process with N total individuals and i
+    individuals of the first type.
+
+    Every pair of players plays a match sampled from outcomes, a dictionary
+    mapping pairs of strategy names to axelrod.Pdf instances, and fitness is
+    the total score of a player. As in the simulations, the first type
+    reproduces when the total fitness is zero.
+    """
+    s1, s2 = strategy_pair
+    same, mixed, other = [outcomes[pair]
+                          for pair in [(s1, s1), (s1, s2), (s2, s2)]]
+    if scale is None:
+        scale = lattice_scale([same, mixed, other])
+    # Represent all matches as a contribution to the total fitness of each type
+    fitness = [(fitness_distribution(same, lambda a, b: (a + b, 0), scale),
+                i * (i - 1) // 2),
+               (fitness_distribution(mixed, lambda a, b: (a, b), scale),
+                i * (N - i)),
+               (fitness_distribution(other, lambda a, b: (0, a + b), scale),
+                (N - i) * (N - i - 1) // 2)]
+    distribution = (np.zeros((1, 2), dtype=np.int64), np.ones(1))
+    for d, size in fitness:
+        distribution = convolve(distribution,
+                                sum_distribution(d, size, max_work),
+                                max_work)
+    values, probabilities = distribution
+    f, g = values.T
+    total = f + g
+    birth = np.where(total > 0, f / np.maximum(total, 1), 1)
+    return float(np.dot(probabilities, birth))
+
+def outcome_fixation(strategy_pair, N, outcomes, max_work=10 ** 6):
+    """
+    Return the fixation probabilities of the first strategy of a pair in an
+    approximate Moran process, for every starting number of individuals of
+    the first type i = 1, ..., N - 1.
+
+    This solves the absorbing Markov chain on the number of individuals of
+    the first type, with transition probabilities obtained exactly from the
+    match outcome distributions, convolved on the lattice of the scores.
+
+    Raises a ValueError if a convolution takes more than max_work pairs of
+    points, or if the scores are not on a lattice.
+    """
+    s1, s2 = strategy_pair
+    scale = lattice_scale([outcomes[pair]
+                           for pair in [(s1, s1), (s1, s2), (s2, s2)]])
+    A = np.zeros((N - 1, N - 1))
+    b = np.zeros(N - 1)
+    for i in range(1, N):
+        birth = outcome_birth_probability(strategy_pair, N, i, outcomes,
+                                          max_work, scale)
+        p_up = birth * (N - i) / N
+        p_down = (1 - birth) * i / N
+        A[i - 1, i - 1] = p_up + p_down
+        if i > 1:
+            A[i - 1, i - 2] = -p_down
+        if i < N - 1:
+            A[i - 1, i] = -p_up
+        else:
+            b[i - 1] = p_up
+    return np.linalg.solve(A, b)
 
 #########
 # Tests #
@@ -136,3 +406,167 @@ class TestFixation(unittest.TestCase):
     def test_defector_v_cooperator(self):
         self.assertEqual(fixation(("Cooperator", "Defector"), 5, 1, utilities),
                          0)
+
+class TestFixationProbabilities(unittest.TestCase):
+    utilities = {("Defector", "Cooperator"): (5, 0),
+                 ("Defector", "Defector"): (1, 1),
+                 ("Cooperator", "Cooperator"): (3, 3),
+                 ("Random", "Random"): (2.25, 2.25),
+                 ("Random", "Cooperator"): (4, 1.5),
+                 ("Defector", "Random"): (3, 0.5)}
+
+    def linear(self, pair, N, **kwargs):
+        ratios = []
+        for j in range(1, N):
+            p_down, _, p_up = transition(pair, N, j, self.utilities, **kwargs)
+            ratios.append(p_down / p_up)
+        return linear_fixation(np.array(ratios))
+
+    def test_matches_linear_space(self):
+        for pair in itertools.permutations(["Cooperator", "Defector",
+                                            "Random"], 2):
+            for N in [2, 3, 10, 20]:
+                for kwargs in [{}, {"fitness_type": "fermi"},
+                               {"selection_intensity": 0.1},
+                               {"selection_intensity": 5}]:
+                    np.testing.assert_allclose(
+                        fixation_probabilities(pair, N, self.utilities,
+                                               **kwargs),
+                        self.linear(pair, N, **kwargs))
+
+    def test_large_N(self):
+        for pair in [("Random", "Defector"), ("Defector", "Random")]:
+            for kwargs in [{}, {"fitness_type": "fermi"}]:
+                fixations = fixation_probabilities(pair, 5000,
+                                                   self.utilities, **kwargs)
+                self.assertEqual(fixations.shape, (4999,))
+                self.assertFalse(np.isnan(fixations).any())
+                self.assertTrue((np.diff(fixations) >= 0).all())
+                self.assertTrue(((0 <= fixations) & (fixations <= 1)).all())
+
+    def test_constant_fitness(self):
+        utilities = {("A", "A"): (2, 2), ("A", "B"): (2, 1), ("B", "B"): (1, 1)}
+        for pair, r in [(("A", "B"), 2.0), (("B", "A"), 0.5)]:
+            for N in [2, 10, 3000]:
+                i = np.arange(1, N)
+                fixations = fixation_probabilities(pair, N, utilities)
+                np.testing.assert_allclose(fixations,
+                                           log_fixation(np.full(N - 1,
+                                                                -np.log(r))),
+                                           atol=1e-300)
+                if N < 1000:
+                    np.testing.assert_allclose(
+                        fixations, (1 - r ** -i) / (1 - r ** -N))
+        utilities = {("A", "A"): (2, 2), ("A", "B"): (2, 2), ("B", "B"): (2, 2)}
+        np.testing.assert_allclose(fixation_probabilities(("A", "B"), 4,
+                                                          utilities),
+                                   [1 / 4, 2 / 4, 3 / 4])
+
+class TestOutcomeFixation(unittest.TestCase):
+    class Pdf:
+        """A minimal stand in for axelrod.Pdf"""
+        def __init__(self, counter):
+            self.sample_space, self.counts = zip(*counter.items())
+            total = sum(self.counts)
+            self.probability = [count / total for count in self.counts]
+
+    def outcomes(self):
+        Pdf = self.Pdf
+        return {("Defector", "Cooperator"): Pdf({(5, 0): 1}),
+                ("Cooperator", "Defector"): Pdf({(0, 5): 1}),
+                ("Defector", "Defector"): Pdf({(1, 1): 1}),
+                ("Cooperator", "Cooperator"): Pdf({(3, 3): 1}),
+                ("Random", "Cooperator"): Pdf({(1, 4): 1, (3, 2): 3}),
+                ("Random", "Random"): Pdf({(2, 2): 1, (1, 3): 1}),
+                ("Cooperator", "Random"): Pdf({(4, 1): 1, (2, 3): 3})}
+
+    def test_sum_distribution(self):
+        distribution = (np.array([[1, 0], [0, 1]]), np.array([0.5, 0.5]))
+        values, probabilities = sum_distribution(distribution, 0)
+        self.assertEqual(values.tolist(), [[0, 0]])
+        self.assertEqual(probabilities.tolist(), [1])
+        values, probabilities = sum_distribution(distribution, 3)
+        self.assertEqual(values.tolist(), [[0, 3], [1, 2], [2, 1], [3, 0]])
+        self.assertEqual(probabilities.tolist(), [0.125, 0.375, 0.375, 0.125])
+
+    def test_lattice_scale(self):
+        Pdf = self.Pdf
+        self.assertEqual(lattice_scale([Pdf({(3, 3): 1}),
+                                        Pdf({(0.5, 2.75): 1, (1, 1): 1})]), 4)
+        self.assertEqual(lattice_scale([Pdf({(2.005, 1): 1})]), 200)
+        with self.assertRaises(ValueError):
+            lattice_scale([Pdf({(-1, 1): 1})])
+
+    def test_zero_fitness(self):
+        # With a total fitness of zero the first type reproduces
+        Pdf = self.Pdf
+        outcomes = {("A", "A"): Pdf({(0, 0): 1}),
+                    ("A", "B"): Pdf({(0, 0): 1, (1, 1): 1}),
+                    ("B", "B"): Pdf({(0, 0): 1})}
+        self.assertEqual(outcome_birth_probability(("A", "B"), 2, 1,
+                                                   outcomes), 0.75)
+
+    def test_birth_probability(self):
+        outcomes = self.outcomes()
+        self.assertEqual(outcome_birth_probability(("Cooperator", "Defector"),
+                                                   2, 1, outcomes), 0)
+        self.assertAlmostEqual(outcome_birth_probability(("Random",
+                                                          "Cooperator"),
+                                                         2, 1, outcomes), 0.5)
+        # One Random, two Cooperators: three matches, enumerated by hand
+        expected = 0
+        for (a, b), p in [((1, 4), 1 / 4), ((3, 2), 3 / 4)]:
+            for (c, d), q in [((1, 4), 1 / 4), ((3, 2), 3 / 4)]:
+                expected += p * q * (a + c) / (a + c + b + d + 6)
+        self.assertAlmostEqual(outcome_birth_probability(("Random",
+                                                          "Cooperator"),
+                                                         3, 1, outcomes),
+                               expected)
+
+    def test_fixation(self):
+        outcomes = self.outcomes()
+        fixation = outcome_fixation(("Cooperator", "Defector"), 5, outcomes)
+        self.assertEqual(len(fixation), 4)
+        self.assertAlmostEqual(fixation[0], 0)
+        fixation = outcome_fixation(("Random", "Cooperator"), 2, outcomes)
+        self.assertAlmostEqual(fixation[0], 0.5)
+        fixation = outcome_fixation(("Random", "Cooperator"), 6, outcomes)
+        reverse = outcome_fixation(("Cooperator", "Random"), 6, outcomes)
+        self.assertTrue(np.allclose(fixation, 1 - reverse[::-1]))
+
+    def test_max_work(self):
+        outcomes = self.outcomes()
+        with self.assertRaises(ValueError):
+            outcome_fixation(("Random", "Cooperator"), 10, outcomes,
+                             max_work=5)
+
+class TestFixationArray(unittest.TestCase):
+    utilities = {("Defector", "Cooperator"): (5, 0),
+                 ("Defector", "Defector"): (1, 1),
+                 ("Cooperator", "Cooperator"): (3, 3),
+                 ("Random", "Random"): (2.25, 2.25),
+                 ("Random", "Cooperator"): (4, 1.5),
+                 ("Defector", "Random"): (3, 0.5)}
+    strategies = ["Cooperator", "Defector", "Random"]
+
+    def test_utilities_matrix(self):
+        A = utilities_matrix(self.utilities, self.strategies)
+        self.assertTrue(np.array_equal(A, np.array([[3, 0, 1.5],
+                                                    [5, 1, 3],
+                                                    [4, 0.5, 2.25]])))
+
+    def test_matches_fixation(self):
+        A = utilities_matrix(self.utilities, self.strategies)
+        Ns = [2, 3, 5, 8]
+        for fitness_type in ["nowak", "fermi"]:
+            fixations = fixation_array(A, Ns, fitness_type=fitness_type)
+            self.assertEqual(fixations.shape, (4, 3, 3, 7))
+            for k, N in enumerate(Ns):
+                for s1, s2 in itertools.permutations(range(3), 2):
+                    pair = (self.strategies[s1], self.strategies[s2])
+                    expected = [fixation(pair, N, i, self.utilities,
+                                         fitness_type=fitness_type)
+                                for i in range(1, N)]
+                    np.testing.assert_allclose(fixations[k, s1, s2, :N - 1],
+                                               expected)
+                    self.assertTrue(np.isnan(fixations[k, s1, s2, N - 1:]).all())
@@ -1,12 +1,15 @@
 """
 A script to draw the validation plots.
 """
+import numpy as np
 import pandas as pd
 import axelrod as axl
 import matplotlib.pyplot as plt
 import csv
 
-import generate_cache
+import moran
+import outcome_store
+from players import strategy_hash
 import theoretic
 
 import functools
@@ -15,50 +18,121 @@ import itertools
 
 
 def simulated_fixation(strategy_pair, N, i=1, repetitions=10,
-                       cachefile=None):
-    """Run an approximate Moran process and obtain the fixation probabilities"""
-    if cachefile is None:
-        cachefile = "../data/outcomes.csv"
-
-    cache = generate_cache.read_csv(cachefile)
-    for k, v in cache.items():
-        cache[k] = axl.Pdf(v)
-
-    players = []
-    for _ in range(i):
-        players.append(strategy_pair[0])
-    for _ in range(N - i):
-        players.append(strategy_pair[1])
-    mp = axl.ApproximateMoranProcess(players, cached_outcomes=cache)
-
-    win_count = 0
-    for seed in range(repetitions):
-        axl.seed(seed)
-        mp.reset()
-        mp.play()
-        if mp.winning_strategy_name == str(players[0]):
-            win_count += 1
+                       cachefile=None, cache=None, root_seed=0):
+    """
+    Run an approximate Moran process and obtain the fixation probabilities
+
+    The match outcomes are read from cachefile unless an already opened cache
+    is given. Pairs whose matches all have a single outcome are not simulated.
 
+    The processes are played by the two type engine of moran.py, every
+    replicate with its own random number stream derived from the root seed
+    and the pair (see `streams.py`).
+    """
+    if cache is None:
+        if cachefile is None:
+            cachefile = "../data/outcomes.csv"
+        cache = outcome_store.read_outcomes(cachefile)
+
+    s1, s2 = map(str, strategy_pair)
+    key = (*map(strategy_hash, strategy_pair), N, i)
+    distributions = moran.two_type_distributions(cache, s1, s2)
+    fixation = None
+    if moran.is_deterministic(distributions):
+        # A single outcome per match: sample whether each replicate fixes
+        # from the exact fixation probability
+        fixation = moran.exact_fixation(s1, s2, N, cache)[i - 1]
+
+    win_count = moran.fixation_wins(distributions, N, i, repetitions,
+                                    fixation=fixation, key=key,
+                                    root_seed=root_seed)
     return win_count / repetitions
 
 
-def theoretic_vs_simulated(repetitions, utilities, filename,
+def simulated_fixations(strategy_pair, N, repetitions=10, cachefile=None,
+                        cache=None, root_seed=0, min_visits=100):
+    """
+    Return the simulated fixation probabilities for i = 1, ..., N - 1 and the
+    number of processes behind each of them.
+
+    The probabilities come from a single set of Moran processes started from
+    N / 2 players of the first type (see moran.visit_fixation): the processes
+    behind p_i are those that visited i. States visited by fewer than
+    min_visits processes, typically i = 1 and i = N - 1, are simulated
+    separately with `repetitions` processes started from i.
+
+    Pairs whose matches all have a single outcome are not simulated: every
+    i is sampled from the exact fixation probability as in
+    simulated_fixation.
+    """
+    if cache is None:
+        if cachefile is None:
+            cachefile = "../data/outcomes.csv"
+        cache = outcome_store.read_outcomes(cachefile)
+
+    s1, s2 = map(str, strategy_pair)
+    sizes = np.full(N - 1, repetitions)
+    distributions = moran.two_type_distributions(cache, s1, s2)
+    if moran.is_deterministic(distributions):
+        return np.array([simulated_fixation(strategy_pair, N, i, repetitions,
+                                            cache=cache, root_seed=root_seed)
+                         for i in range(1, N)]), sizes
+
+    n = max(N // 2, 1)
+    hashes = tuple(map(strategy_hash, strategy_pair))
+    visits, wins = moran.visit_fixation_wins(distributions, N, n, repetitions,
+                                             key=(*hashes, N, n),
+                                             root_seed=root_seed)
+    visits, wins = visits[1:N], wins[1:N]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fixations = wins / visits
+    for i in range(1, N):
+        if visits[i - 1] >= min_visits:
+            sizes[i - 1] = visits[i - 1]
+        else:
+            # Too few visits: run processes started from i
+            fixations[i - 1] = moran.fixation_wins(
+                distributions, N, i, repetitions, engine="batch",
+                key=(*hashes, N, i), root_seed=root_seed) / repetitions
+    return fixations, sizes
+
+
+def theoretic_fixations(utilities, player_names, Ns):
+    """
+    Return a dictionary mapping a pair of player names and a population size
+    to the theoretic fixation probabilities for i = 1, ..., N - 1.
+    """
+    strategies = sorted(set(itertools.chain(*player_names)))
+    index = {strategy: k for k, strategy in enumerate(strategies)}
+    A = theoretic.utilities_matrix(utilities, strategies)
+    fixations = theoretic.fixation_array(A, Ns)
+    return {(s1, s2, N): fixations[k, index[s1], index[s2], :N - 1]
+            for k, N in enumerate(Ns) for s1, s2 in player_names}
+
+
+def theoretic_vs_simulated(repetitions, fixations, cache, filename,
                            N, player1, player2):
     """
     Return the theoretic values and the simulated values
+
+    The simulated values for every starting population come from a single
+    set of processes (see simulated_fixations). The repetitions written for
+    each row are the number of processes behind its simulated value.
     """
     players = (player1, player2)
 
     starting_pop = [1, N // 2, N - 1] if N != 2 else [1]
+    simulated, sizes = simulated_fixations(players, N, repetitions=repetitions,
+                                           cache=cache)
 
     for i in starting_pop:
         player_names = [str(p) for p in players]
-        t = theoretic.fixation(player_names, N, i, utilities=utilities)
-        s = simulated_fixation(players,  N, i, repetitions=repetitions)
+        t = fixations[(*player_names, N)][i - 1]
+        s = simulated[i - 1]
 
         with open(filename, "a") as f:
             writer = csv.writer(f)
-            writer.writerow([repetitions, N, i, *player_names, t, s])
+            writer.writerow([int(sizes[i - 1]), N, i, *player_names, t, s])
 
 
 if __name__ == "__main__":
@@ -118,13 +192,20 @@ if __name__ == "__main__":
     utilities = {pair: (f["Score 1"].mean(), f["Score 2"].mean())
                  for pair, f in df.groupby(["Player 1", "Player 2"])}
 
+    Ns = range(2, max_N + 1, 2)
+    fixations = theoretic_fixations(utilities,
+                                    [tuple(map(str, players))
+                                     for players in player_pairs], Ns)
+
+    # Parsed once: workers reopen the memory mapped store
+    cache = outcome_store.read_outcomes(outcomes_file)
+
     processes = multiprocessing.cpu_count()
 
     func = functools.partial(theoretic_vs_simulated, repetitions,
-                             utilities, output_file)
+                             fixations, cache, output_file)
     p = multiprocessing.Pool(processes)
 
     args = ((N, *players)
-            for N, players in itertools.product(range(2, max_N + 1, 2),
-                                                player_pairs))
+            for N, players in itertools.product(Ns, player_pairs))
     p.starmap(func, args)
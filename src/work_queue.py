@@ -0,0 +1,324 @@
+"""
+A work queue in a shared directory, to run the tasks of a sweep on several
+machines.
+
+The coordinator puts every task in `<queue>/tasks` as a json file. Workers,
+started on any machine that sees the directory, claim a task by moving its file
+to `<queue>/claimed`: a rename is atomic, so each task is claimed by a single
+worker. A worker writes the rows returned by a task to `<queue>/done`, where
+the coordinator collects them and writes them to the output file, as it does
+for a pool of processes (see `results.py`).
+
+While it runs a task, a worker touches its claimed file every `heartbeat`
+seconds. Tasks whose claimed file is untouched for longer than a timeout, by a
+worker that has stopped, are put back in the queue. Once every task is
+collected, the coordinator writes `<queue>/finished` and the workers stop. A
+`finished` file left by an earlier run is removed when the coordinator creates
+the queue, and workers started before that ignore it.
+"""
+import functools
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+import uuid
+
+# For tests
+import tempfile
+import unittest
+
+
+def write_json(path, data):
+    """Write data to a json file, atomically."""
+    path = Path(path)
+    temporary = path.with_name("." + path.name + ".tmp")
+    with temporary.open("w") as f:
+        json.dump(data, f, default=lambda value: value.item())
+    os.replace(str(temporary), str(path))
+
+
+def read_json(path):
+    with Path(path).open("r") as f:
+        return json.load(f)
+
+
+def task_files(directory):
+    """Return the json files of a directory, in order of their names."""
+    try:
+        names = sorted(name for name in os.listdir(str(directory))
+                       if name.endswith(".json"))
+    except FileNotFoundError:
+        return []
+    return [Path(directory) / name for name in names]
+
+
+def clear(queue):
+    """Remove the tasks and results of previous runs from a queue."""
+    queue = Path(queue)
+    for name in ["tasks", "claimed", "done"]:
+        (queue / name).mkdir(parents=True, exist_ok=True)
+        for path in (queue / name).iterdir():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+    if (queue / "finished").exists():
+        (queue / "finished").unlink()
+
+
+def finished_stamp(queue):
+    """Return the modification time of `<queue>/finished`, None if absent."""
+    try:
+        return (Path(queue) / "finished").stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def call(func, args):
+    """
+    Return the json description of func(*args): func is a module level
+    function, or a functools.partial of one, that workers look up by name.
+    """
+    keywords = {}
+    if isinstance(func, functools.partial):
+        args = list(func.args) + list(args)
+        keywords = func.keywords
+        func = func.func
+    return {"function": func.__name__, "args": list(args),
+            "keywords": keywords}
+
+
+def collect(func, tasks, queue, poll=1, timeout=3600):
+    """
+    Put func(*task) for every task in the queue and return the (task, rows,
+    seconds) of every task run by the workers, as they finish.
+
+    The queue is created, and cleared, when collect is called rather than when
+    the results are first iterated over.
+    """
+    queue = Path(queue)
+    clear(queue)
+    return collect_tasks(func, tasks, queue, poll, timeout)
+
+
+def collect_tasks(func, tasks, queue, poll, timeout):
+    """Put the tasks in a cleared queue and yield their results."""
+    run = uuid.uuid4().hex
+    submitted = {}
+    for k, task in enumerate(tasks):
+        name = "{}-{:08d}.json".format(run, k)
+        submitted[name] = task
+        write_json(queue / "tasks" / name, call(func, task))
+
+    while submitted:
+        found = False
+        for path in task_files(queue / "done"):
+            if path.name in submitted:
+                result = read_json(path)
+                found = True
+                yield (submitted.pop(path.name), result["rows"],
+                       result["seconds"])
+            path.unlink()
+
+        if timeout is not None:
+            # Put back the tasks of workers that have stopped
+            for path in task_files(queue / "claimed"):
+                try:
+                    if time.time() - path.stat().st_mtime > timeout:
+                        os.rename(str(path), str(queue / "tasks" / path.name))
+                except FileNotFoundError:
+                    pass
+
+        if not found:
+            time.sleep(poll)
+
+    (queue / "finished").touch()
+
+
+def claim(queue):
+    """Claim the first task of the queue, returning its path or None."""
+    queue = Path(queue)
+    for path in task_files(queue / "tasks"):
+        claimed = queue / "claimed" / path.name
+        try:
+            os.rename(str(path), str(claimed))
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        os.utime(str(claimed))
+        return claimed
+    return None
+
+
+def beat(path, stop, heartbeat):
+    """Touch a claimed file every heartbeat seconds until stop is set."""
+    while not stop.wait(heartbeat):
+        try:
+            os.utime(str(path))
+        except FileNotFoundError:
+            # Put back in the queue or removed by a new run
+            return
+
+
+def work(queue, functions, poll=1, heartbeat=60):
+    """
+    Run the tasks of the queue until the coordinator has collected them all.
+
+    functions maps the names of the functions tasks may call to the functions.
+    The claimed file of a running task is touched every heartbeat seconds,
+    which must be well below the timeout of the coordinator. A `finished` file
+    already there when the worker starts is from an earlier run: the worker
+    waits for the next one. Returns the number of tasks run.
+    """
+    queue = Path(queue)
+    stale = finished_stamp(queue)
+    count = 0
+    while True:
+        path = claim(queue)
+        if path is None:
+            if finished_stamp(queue) not in (None, stale):
+                return count
+            time.sleep(poll)
+            continue
+        try:
+            task = read_json(path)
+        except FileNotFoundError:
+            # Removed by a new run of the coordinator
+            continue
+        stop = threading.Event()
+        beater = threading.Thread(target=beat, args=(path, stop, heartbeat),
+                                  daemon=True)
+        beater.start()
+        start = time.perf_counter()
+        try:
+            rows = functions[task["function"]](*task["args"],
+                                               **task["keywords"])
+        finally:
+            stop.set()
+            beater.join()
+        seconds = time.perf_counter() - start
+        write_json(queue / "done" / path.name,
+                   {"rows": rows, "seconds": seconds,
+                    "worker": "{}-{}".format(socket.gethostname(),
+                                             os.getpid())})
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        count += 1
+
+
+#########
+# Tests #
+#########
+
+
+def rows_of(i, n, label="Player"):
+    """Return n rows for task i"""
+    return [[i, k, "{}, {}".format(label, i)] for k in range(n)]
+
+
+slow_calls = []
+
+
+def slow_rows_of(i, n, seconds):
+    """Return n rows for task i after sleeping, counting the calls"""
+    slow_calls.append(i)
+    time.sleep(seconds)
+    return rows_of(i, n)
+
+
+class TestWorkQueue(unittest.TestCase):
+    def test_call(self):
+        self.assertEqual(call(rows_of, (1, 2)),
+                         {"function": "rows_of", "args": [1, 2],
+                          "keywords": {}})
+        func = functools.partial(rows_of, label="Strategy")
+        self.assertEqual(call(functools.partial(func, 1), (2,)),
+                         {"function": "rows_of", "args": [1, 2],
+                          "keywords": {"label": "Strategy"}})
+
+    def test_claim(self):
+        with tempfile.TemporaryDirectory() as queue:
+            clear(queue)
+            write_json(Path(queue) / "tasks" / "b.json", call(rows_of, (1, 1)))
+            write_json(Path(queue) / "tasks" / "a.json", call(rows_of, (0, 1)))
+            self.assertEqual(claim(queue).name, "a.json")
+            self.assertEqual(claim(queue).name, "b.json")
+            self.assertIsNone(claim(queue))
+            self.assertEqual(len(task_files(Path(queue) / "claimed")), 2)
+
+    def start_workers(self, queue, count, heartbeat=60):
+        workers = [threading.Thread(target=work,
+                                    args=(queue, {"rows_of": rows_of,
+                                                  "slow_rows_of": slow_rows_of}),
+                                    kwargs={"poll": 0.01,
+                                            "heartbeat": heartbeat})
+                   for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def test_collect(self):
+        tasks = [(i, i % 3 + 1) for i in range(10)]
+        func = functools.partial(rows_of, label="Strategy")
+        with tempfile.TemporaryDirectory() as queue:
+            clear(queue)
+            # A task left by a previous run is discarded
+            write_json(Path(queue) / "tasks" / "old.json", call(func, (0, 1)))
+            workers = self.start_workers(queue, 2)
+            collected = list(collect(func, tasks, queue, poll=0.01))
+            for worker in workers:
+                worker.join()
+            self.assertEqual(sorted(task for task, _, _ in collected), tasks)
+            for task, rows, seconds in collected:
+                self.assertEqual(rows, func(*task))
+                self.assertGreaterEqual(seconds, 0)
+            self.assertTrue((Path(queue) / "finished").exists())
+            for name in ["tasks", "claimed"]:
+                self.assertEqual(task_files(Path(queue) / name), [])
+
+    def test_requeue(self):
+        with tempfile.TemporaryDirectory() as queue:
+            collected = []
+            coordinator = threading.Thread(
+                target=lambda: collected.extend(
+                    collect(rows_of, [(0, 2)], queue, poll=0.01,
+                            timeout=0.05)))
+            coordinator.start()
+            # A worker claims the task and stops
+            while claim(queue) is None:
+                time.sleep(0.01)
+            workers = self.start_workers(queue, 1)
+            coordinator.join()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(collected[0][:2], ((0, 2), rows_of(0, 2)))
+
+    def test_heartbeat(self):
+        del slow_calls[:]
+        with tempfile.TemporaryDirectory() as queue:
+            clear(queue)
+            workers = self.start_workers(queue, 2, heartbeat=0.02)
+            # The task runs for longer than the timeout, but is not put back
+            collected = list(collect(slow_rows_of, [(0, 2, 0.5)], queue,
+                                     poll=0.01, timeout=0.2))
+            for worker in workers:
+                worker.join()
+            self.assertEqual(slow_calls, [0])
+            self.assertEqual(collected[0][1], rows_of(0, 2))
+
+    def test_stale_finished(self):
+        with tempfile.TemporaryDirectory() as queue:
+            clear(queue)
+            (Path(queue) / "finished").touch()
+            # Workers started before the coordinator wait for its tasks
+            workers = self.start_workers(queue, 1)
+            time.sleep(0.05)
+            self.assertTrue(workers[0].is_alive())
+            self.assertIsNone(finished_stamp(Path(queue) / "missing"))
+            collected = list(collect(rows_of, [(0, 2)], queue, poll=0.01))
+            workers[0].join()
+            self.assertEqual(collected[0][:2], ((0, 2), rows_of(0, 2)))